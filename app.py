@@ -1,10 +1,14 @@
 import dash
 import dash_bootstrap_components as dbc
-from dash_extensions.enrich import DashProxy, ServersideOutputTransform
+from dash_extensions.enrich import DashProxy
+
+import endpoints
+import metrics
+import transport
+import utils
 
 app = DashProxy(
     __name__,
-    transforms=[ServersideOutputTransform()],
     use_pages=True,
     suppress_callback_exceptions=True,
     external_stylesheets=[dbc.themes.DARKLY],
@@ -29,10 +33,26 @@ navbar = dbc.NavbarSimple(
     fluid=True
 )
 
+# routes which are not part of the dash app, e.g. the GeoJSON of the map
+app.server.register_blueprint(endpoints.blueprint)
+
+# faster json serialization and compression of the responses (both opt-in, see transport.py)
+transport.init_app(app.server)
+
+# duration and payload sizes of the callbacks for /metrics (opt-in, see metrics.py)
+metrics.init_app(app.server, app.callback_map)
+
 app.layout = dbc.Container(
     [navbar, dash.page_container],
     fluid=True,
 )
 
+# the flask server, e.g. for gunicorn app:server (see gunicorn.conf.py)
+server = app.server
+
 if __name__ == "__main__":
+    # prepare the data in the background, the home page shows a placeholder until it is ready.
+    # This is not done on import: gunicorn.conf.py prepares the data before the workers are
+    # forked, with other servers the first visit of the home page starts the preparation
+    utils.warm_up()
     app.run(debug=False)
@@ -0,0 +1,19 @@
+// functions used by the dash leaflet components, see dash_extensions.javascript.Namespace
+window.dashExtensions = Object.assign({}, window.dashExtensions, {
+    default: {
+        // the clusters are created on the server, draw them like the clusters of dash leaflet
+        pointToLayer: function (feature, latlng) {
+            if (!feature.properties.cluster) {
+                return L.marker(latlng);
+            }
+            const count = feature.properties.point_count;
+            const size = count < 100 ? 'small' : count < 1000 ? 'medium' : 'large';
+            const icon = L.divIcon({
+                html: '<div><span>' + feature.properties.point_count_abbreviated + '</span></div>',
+                className: 'marker-cluster marker-cluster-' + size,
+                iconSize: L.point(40, 40)
+            });
+            return L.marker(latlng, {icon: icon});
+        }
+    }
+});
@@ -0,0 +1,79 @@
+"""
+synthetic transactions in the format of liquor_iowa_2021.csv, e.g.
+
+    python benchmarks/generate.py liquor_10x.csv --scale 10
+
+The stores are spread over Iowa, every store has a fixed location and the sales are drawn
+from a skewed distribution (few large stores, many small ones) for every day of 2021.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+import os
+
+# rows and stores of the scale 1x
+BASE_ROWS = 200_000
+BASE_STORES = 2_000
+
+# bounding box of Iowa (south, west, north, east)
+BOUNDS = (40.4, -96.6, 43.5, -90.1)
+
+# share of the rows without a store location, like in the real data
+MISSING_LOCATION = 0.01
+
+
+def generate(path, scale=1, seed=0, rows=None, stores=None, chunk_rows=1_000_000):
+    """function writes the synthetic csv to path (in chunks) and returns the number of rows"""
+    rows = int(rows or BASE_ROWS * scale)
+    stores = int(stores or BASE_STORES * scale)
+    rng = np.random.default_rng(seed)
+
+    # the stores: number, location and popularity
+    numbers = 2000 + np.arange(stores)
+    south, west, north, east = BOUNDS
+    lat = rng.uniform(south, north, stores).round(5)
+    lon = rng.uniform(west, east, stores).round(5)
+    locations = np.array([f'POINT ({x} {y})' for x, y in zip(lon, lat)], dtype=object)
+    names = np.array([f'STORE {number}' for number in numbers], dtype=object)
+    weights = rng.pareto(1.5, stores) + 1
+    weights /= weights.sum()
+    days = pd.date_range('2021-01-01', '2021-12-31').strftime('%Y-%m-%d').to_numpy()
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    written = 0
+    while written < rows:
+        n = min(chunk_rows, rows - written)
+        store = rng.choice(stores, n, p=weights)
+        bottles = rng.integers(1, 48, n)
+        volume = rng.choice([0.05, 0.2, 0.375, 0.75, 1.0, 1.75], n) * bottles
+        store_location = locations[store]
+        store_location[rng.random(n) < MISSING_LOCATION] = None
+
+        df = pd.DataFrame({
+            'invoice_line_no': [f'INV-{i:011d}' for i in range(written, written + n)],
+            'date': days[rng.integers(0, len(days), n)],
+            'store_number': numbers[store],
+            'store_name': names[store],
+            'city': 'DES MOINES',
+            'store_location': store_location,
+            'bottles_sold': bottles,
+            'sale_dollars': (bottles * rng.uniform(4, 40, n)).round(2),
+            'volume_sold_liters': volume.round(2),
+            'volume_sold_gallons': (volume * 0.264172).round(2),
+        })
+        df.to_csv(tmp_path, mode='a', header=written == 0, index=False)
+        written += n
+
+    os.replace(tmp_path, path)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write synthetic liquor transactions')
+    parser.add_argument('path')
+    parser.add_argument('--scale', type=float, default=1, help='1 = 200k rows and 2k stores')
+    parser.add_argument('--rows', type=int, help='number of rows (overrides the scale)')
+    parser.add_argument('--stores', type=int, help='number of stores (overrides the scale)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.path, args.scale, args.seed, args.rows, args.stores), 'rows written')
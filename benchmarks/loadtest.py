@@ -0,0 +1,277 @@
+"""
+load test of the home page with concurrent sessions. Every session sends the requests of a
+user: page load (layout, map and clusters), click on a store, change of the metrics and
+the resolution of the store chart, the comparison with the neighbors for several k and
+quarters and with the region of the store and the selection of the stores around it. E.g.
+
+    python benchmarks/loadtest.py --sessions 50 --concurrency 8
+    python benchmarks/loadtest.py --url http://127.0.0.1:8050 --sessions 200 --concurrency 16
+
+Without --url the app is imported and driven in-process by the flask test client (the data
+is set by LIQUOR_DATA_SOURCE). With --url a running server is used, e.g. gunicorn app:server.
+The report contains the throughput, the latency percentiles and the bytes per request.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import http.client
+import gzip
+import argparse
+import random
+import time
+import json
+import sys
+import os
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CALLBACK_PATH = '/_dash-update-component'
+QUARTERS = ['2021Q1', '2021Q2', '2021Q3', '2021Q4']
+
+
+def decode(data, encoding):
+    """function returns the uncompressed body of a response"""
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(data)
+    return data
+
+
+# Class for the requests of a session to the in-process flask app
+class TestClient:
+    def __init__(self, server, headers):
+        self.client = server.test_client()
+        self.headers = headers
+
+    def request(self, method, path, body=None):
+        """function returns the status, the size of the body and the uncompressed body"""
+        response = self.client.open(path, method=method, json=body, headers=self.headers)
+        return response.status_code, len(response.data), decode(response.data, response.headers.get('Content-Encoding'))
+
+
+# Class for the requests of a session to a running server, the connection is kept alive
+class HttpClient:
+    def __init__(self, url, headers):
+        url = urlsplit(url)
+        self.prefix = url.path.rstrip('/')
+        self.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        self.headers = headers
+
+    def request(self, method, path, body=None):
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, self.prefix + path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        return response.status, len(data), decode(data, response.getheader('Content-Encoding'))
+
+
+def callback_body(outputs, inputs, state=(), changed=None):
+    """function returns the body of a request to _dash-update-component like the browser sends it"""
+    if isinstance(outputs, list):
+        output = '..' + '...'.join(f'{o["id"]}.{o["property"]}' for o in outputs) + '..'
+    else:
+        output = f'{outputs["id"]}.{outputs["property"]}'
+    return {
+        'output': output,
+        'outputs': outputs,
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': changed or [f'{i}.{p}' for i, p, v in inputs],
+    }
+
+
+def session_steps(store, location, rng):
+    """
+    function returns the requests (step, method, path, body) of a session which clicks the store
+    at location (lon, lat) and selects the stores around it
+    """
+    store = str(store)
+    graph_1 = [{'id': 'graph_1', 'property': 'figure'}, {'id': 'chart_metrics', 'property': 'data'}]
+    neighbors = [{'id': 'g2', 'property': 'style'}, {'id': 'graph_2', 'property': 'figure'}]
+    metrics = ['sale_dollars', 'bottles_sold']
+
+    def compare(k, quarter, changed, mode='neighbors', size=50):
+        inputs = [
+            ('store_id', 'data', store), ('drop_neighbors', 'value', k), ('radio_quarter', 'value', quarter),
+            ('compare_mode', 'value', mode), ('region_size', 'value', size)
+        ]
+        return callback_body(neighbors, inputs, changed=[changed])
+
+    def figure(resolution, chart_type, changed):
+        inputs = [('drop', 'value', metrics), ('resolution', 'value', resolution), ('chart_type', 'value', chart_type)]
+        state = [('chart_stores', 'data', [int(store)]), ('chart_metrics', 'data', ['sale_dollars'])]
+        return callback_body(graph_1, inputs, state, [changed])
+
+    # a rectangle of about 1 to 3 degrees around the store is drawn on the map
+    lon, lat = location
+    size = rng.uniform(0.5, 1.5)
+    rectangle = [[lon - size, lat - size], [lon + size, lat - size], [lon + size, lat + size], [lon - size, lat + size]]
+    shapes = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'type': 'rectangle'},
+         'geometry': {'type': 'Polygon', 'coordinates': [rectangle + rectangle[:1]]}}
+    ]}
+
+    k = rng.randint(2, 6)
+    quarter = rng.choice(QUARTERS)
+    return [
+        ('page', 'GET', '/', None),
+        ('layout', 'GET', '/_dash-layout', None),
+        ('prepare_date', 'POST', CALLBACK_PATH, callback_body(
+            [{'id': 'geomap', 'property': 'children'}, {'id': 'ready_poll', 'property': 'disabled'}],
+            [('ready_poll', 'n_intervals', None)]
+        )),
+        ('clusters', 'GET', '/data/clusters.geojson?zoom=5&bbox=-101.25,33.75,-84.375,50.625', None),
+        ('liquor_store_id', 'POST', CALLBACK_PATH, callback_body(
+            {'id': 'store_id', 'property': 'data'},
+            [('liquor_stores', 'click_feature', {'properties': {'id': store, 'tooltip': store}})]
+        )),
+        ('get_stats', 'POST', CALLBACK_PATH, callback_body(
+            {'id': 'g1', 'property': 'children'}, [('store_id', 'data', store), ('selected_stores', 'data', None)],
+            changed=['store_id.data']
+        )),
+        ('compare_with_neighbors store', 'POST', CALLBACK_PATH, compare(None, '2021Q1', 'store_id.data')),
+        ('update_figure metrics', 'POST', CALLBACK_PATH, figure('Daily', 'bar', 'drop.value')),
+        ('update_figure resolution', 'POST', CALLBACK_PATH, figure(rng.choice(['Weekly', 'Monthly']), 'bar', 'resolution.value')),
+        ('compare_with_neighbors k', 'POST', CALLBACK_PATH, compare(k, '2021Q1', 'drop_neighbors.value')),
+        ('compare_with_neighbors quarter', 'POST', CALLBACK_PATH, compare(k, quarter, 'radio_quarter.value')),
+        ('compare_with_neighbors region', 'POST', CALLBACK_PATH, compare(
+            k, quarter, 'compare_mode.value', rng.choice(['radius', 'k']), rng.choice([50, 200, 500])
+        )),
+        ('select_stores', 'POST', CALLBACK_PATH, callback_body(
+            {'id': 'selected_stores', 'property': 'data'}, [('edit_control', 'geojson', shapes)]
+        )),
+    ]
+
+
+def run_session(make_client, headers, store, location, seed):
+    """function runs a session and returns the measurements (step, seconds, bytes, status)"""
+    client = make_client(headers)
+    rng = random.Random(seed)
+    measurements = []
+
+    def send(step, method, path, body):
+        start = time.perf_counter()
+        status, size, data = client.request(method, path, body)
+        measurements.append((step, time.perf_counter() - start, size, status))
+        return status, data
+
+    for step in session_steps(store, location, rng):
+        status, data = send(*step)
+
+    # the chart of the selected stores, the selection is the response of select_stores (the last step)
+    if status == 200:
+        selected = json.loads(data)['response']['selected_stores']['data']
+        send('get_stats selection', 'POST', CALLBACK_PATH, callback_body(
+            {'id': 'g1', 'property': 'children'},
+            [('store_id', 'data', str(store)), ('selected_stores', 'data', selected)],
+            changed=['selected_stores.data']
+        ))
+    return measurements
+
+
+def wait_ready(client, timeout):
+    """function waits until the data of the app has been prepared"""
+    start = time.time()
+    while True:
+        status, _, data = client.request('GET', '/ready')
+        if status == 200:
+            return json.loads(data)
+        if time.time() - start > timeout:
+            raise TimeoutError(f'app not ready after {timeout} seconds: {data!r}')
+        time.sleep(0.5)
+
+
+def store_locations(client):
+    """function returns the number and location (lon, lat) of all stores, i.e. the clusters above the maximum zoom level"""
+    status, _, data = client.request('GET', '/data/clusters.geojson?zoom=99&bbox=-180,-90,180,90')
+    return [
+        (int(feature['properties']['id']), feature['geometry']['coordinates'])
+        for feature in json.loads(data)['features']
+    ]
+
+
+def summary(measurements, seconds):
+    """function returns the latency percentiles (ms), the bytes per request and the throughput"""
+    latency = np.array([m[1] for m in measurements]) * 1000
+    size = np.array([m[2] for m in measurements])
+    return {
+        'requests': len(measurements),
+        'errors': sum(m[3] >= 400 for m in measurements),
+        'requests_per_second': round(len(measurements) / seconds, 2) if seconds else None,
+        'p50_ms': round(float(np.percentile(latency, 50)), 2),
+        'p95_ms': round(float(np.percentile(latency, 95)), 2),
+        'p99_ms': round(float(np.percentile(latency, 99)), 2),
+        'mean_bytes': int(size.mean()),
+        'total_bytes': int(size.sum()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test of the home page with concurrent sessions')
+    parser.add_argument('--url', help='url of a running server, otherwise the app runs in-process')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4, help='number of sessions at the same time')
+    parser.add_argument('--gzip', action='store_true', help='accept compressed responses')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the data')
+    parser.add_argument('--output', help='write the report to this json file')
+    args = parser.parse_args()
+
+    headers = {'Accept-Encoding': 'br, gzip' if args.gzip else 'identity'}
+    if args.url:
+        def make_client(headers):
+            return HttpClient(args.url, headers)
+    else:
+        import app
+        import utils
+        utils.warm_up()
+
+        def make_client(headers):
+            return TestClient(app.server, headers)
+
+    client = make_client(headers)
+    progress = wait_ready(client, args.timeout)
+    stores = store_locations(client)
+    rng = random.Random(args.seed)
+    sessions = [(*rng.choice(stores), args.seed + i) for i in range(args.sessions)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda session: run_session(make_client, headers, *session), sessions))
+    seconds = time.perf_counter() - start
+
+    measurements = [m for session in results for m in session]
+    steps = {}
+    for m in measurements:
+        steps.setdefault(m[0], []).append(m)
+
+    report = {
+        'config': dict(vars(args), preparation=progress.get('seconds')),
+        'seconds': round(seconds, 3),
+        'sessions_per_second': round(args.sessions / seconds, 2),
+        'total': summary(measurements, seconds),
+        'steps': {step: summary(ms, seconds) for step, ms in steps.items()},
+    }
+
+    print(f'{args.sessions} sessions in {seconds:.1f}s ({report["sessions_per_second"]} sessions/s)')
+    print(f'{"step":<32} {"requests":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"bytes":>9} {"errors":>6}')
+    for step, s in list(report['steps'].items()) + [('total', report['total'])]:
+        print(
+            f'{step:<32} {s["requests"]:>8} {s["requests_per_second"]:>8} {s["p50_ms"]:>8} {s["p95_ms"]:>8} '
+            f'{s["p99_ms"]:>8} {s["mean_bytes"]:>9} {s["errors"]:>6}'
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+benchmarks of the data preparation, the store index, the map layers and the callbacks of the
+home page on synthetic data (see generate.py). No network access is needed, e.g.
+
+    python benchmarks/run.py --scales 1 10 --output before.json
+    python benchmarks/run.py --scales 1 10 --output after.json --compare before.json
+
+The results are the median (and minimum) seconds of several runs per benchmark. With --compare
+every benchmark is compared with an earlier result, the script exits with 1 if the minimum of
+a benchmark is slower than --threshold times its earlier minimum (and by more than a millisecond,
+shorter differences are noise). The minimum is less affected by other load on the machine.
+"""
+from contextvars import copy_context
+import argparse
+import platform
+import tempfile
+import time
+import json
+import sys
+import os
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate import generate  # noqa: E402
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'liquor_benchmarks')
+
+# smaller differences of the minimums are not reported as regressions
+MIN_DIFFERENCE = 0.001
+
+
+def timeit(fn, repeat, setup=None):
+    """function returns the median and minimum seconds of repeat calls of fn and the last result"""
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+    return {'median': round(float(np.median(seconds)), 6), 'min': round(min(seconds), 6), 'repeat': repeat}, result
+
+
+def data_path(data_dir, scale, seed):
+    """function returns the path of the synthetic csv of the scale, it is generated once"""
+    path = os.path.join(data_dir, f'liquor_{scale:g}x_{seed}.csv')
+    if not os.path.isfile(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print(f'generating {path}', file=sys.stderr)
+        generate(path, scale, seed)
+    return path
+
+
+def in_callback(fn, *args, triggered):
+    """function calls the callback function fn like dash does, triggered is e.g. 'drop.value'"""
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+
+    def run():
+        context_value.set(AttributeDict(triggered_inputs=[{'prop_id': triggered, 'value': None}]))
+        return fn(*args)
+
+    return copy_context().run(run)
+
+
+def bench_prepare(utils, path, repeat):
+    """benchmarks of the stages of the data preparation, without and with the parquet cache"""
+    results = {}
+    stages = {}
+    for _ in range(repeat):
+        utils.update_progress(seconds={})
+        start = time.perf_counter()
+        utils.prepare_data(path, cache_dir='')
+        stages.setdefault('total', []).append(time.perf_counter() - start)
+        for name, seconds in utils.progress_snapshot()['seconds'].items():
+            stages.setdefault(name, []).append(seconds)
+    for name, seconds in stages.items():
+        results[f'prepare_data/{name}'] = {
+            'median': round(float(np.median(seconds)), 6), 'min': round(min(seconds), 6), 'repeat': repeat
+        }
+
+    cache_dir = tempfile.mkdtemp(prefix='liquor_cache_')
+    df = utils.load_data(path, cache_dir)
+    results['load_data/parquet cache'], _ = timeit(lambda: utils.load_data(path, cache_dir), repeat)
+
+    # the daily totals with one thread and with the threads of the app and of all cores
+    for workers in sorted({1, utils.PREPARE_WORKERS, os.cpu_count() or 1}):
+        results[f'daily_totals workers={workers}'], _ = timeit(lambda: utils.daily_totals(df, workers), repeat)
+    return results
+
+
+def bench_indexes(utils, dataset, stores, repeat):
+    """benchmarks of the store index (BallTree) and the clusters of the markers"""
+    results = {}
+    numbers, coordinates = dataset.stores.numbers, dataset.stores.coordinates
+
+    results['StoreIndex/build'], _ = timeit(lambda: utils.StoreIndex(numbers, coordinates), repeat)
+    results['StoreIndex/nearest'], _ = timeit(
+        lambda: [dataset.stores.nearest(store, utils.MAX_NEIGHBORS) for store in stores], repeat
+    )
+    results['StoreIndex/within 25 km'], _ = timeit(
+        lambda: [dataset.stores.within(store, 25) for store in stores], repeat
+    )
+    results['Dataset/region 500 km'], _ = timeit(
+        lambda: [dataset.region(store, '2021Q1', radius_km=500) for store in stores], repeat
+    )
+    results['ClusterIndex/build'], _ = timeit(lambda: utils.ClusterIndex(numbers, coordinates), repeat)
+    for zoom in (5, 9, 13):
+        key = f'ClusterIndex/geojson zoom {zoom}'
+        results[key], body = timeit(lambda: dataset.clusters.geojson((-96.6, 40.4, -90.1, 43.5), zoom), repeat)
+        results[key]['bytes'] = len(body)
+    return results
+
+
+def bench_callbacks(app, utils, home, stores, repeat):
+    """benchmarks of the callbacks of the home page, called directly. Cold: without the figure cache"""
+    from plotly.io.json import to_json_plotly
+
+    results = {}
+    clear = utils.figure_cache.clear
+    store = str(stores[0])
+
+    def run(name, fn, setup=None):
+        results[name], output = timeit(fn, repeat, setup)
+        results[f'{name} (serialize)'], body = timeit(lambda: to_json_plotly(output), repeat)
+        results[name]['bytes'] = len(body)
+
+    with app.server.test_request_context('/'):
+        run('prepare_date', lambda: in_callback(home.prepare_date, 1, triggered='ready_poll.n_intervals'))
+        run(
+            'update_clusters',
+            lambda: in_callback(home.update_clusters, [[40.4, -96.6], [43.5, -90.1]], 7, triggered='basemap.zoom')
+        )
+
+    feature = {'properties': {'id': store}}
+    run('liquor_store_id', lambda: in_callback(home.liquor_store_id, feature, triggered='liquor_stores.click_feature'))
+
+    run('get_stats cold', lambda: in_callback(home.get_stats, store, None, triggered='store_id.data'), clear)
+    run('get_stats cached', lambda: in_callback(home.get_stats, store, None, triggered='store_id.data'))
+
+    selection = ['bottles_sold', 'sale_dollars']
+    run(
+        'update_figure metrics',
+        lambda: in_callback(
+            home.update_figure, selection, 'Daily', 'bar', [int(store)], ['sale_dollars'], triggered='drop.value'
+        )
+    )
+    for resolution, chart_type in (('Weekly', 'bar'), ('Daily', 'line')):
+        run(
+            f'update_figure {resolution} {chart_type} cold',
+            lambda: in_callback(
+                home.update_figure, selection, resolution, chart_type, [int(store)], selection,
+                triggered='resolution.value'
+            ),
+            clear
+        )
+
+    for k in (2, utils.MAX_NEIGHBORS):
+        run(
+            f'compare_with_neighbors k={k} cold',
+            lambda: in_callback(
+                home.compare_with_neighbors, store, k, '2021Q1', 'neighbors', 50, triggered='drop_neighbors.value'
+            ),
+            clear
+        )
+    run(
+        'compare_with_neighbors quarter',
+        lambda: in_callback(
+            home.compare_with_neighbors, store, utils.MAX_NEIGHBORS, '2021Q3', 'neighbors', 50,
+            triggered='radio_quarter.value'
+        )
+    )
+    # a box around half of the stores and around all stores drawn on the map
+    for name, (west, south, east, north) in (('half', (-96.6, 40.4, -93.35, 43.5)), ('all', (-96.6, 40.4, -90.1, 43.5))):
+        ring = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+        shapes = {'type': 'FeatureCollection', 'features': [{'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]}
+        run(f'select_stores {name}', lambda: in_callback(home.select_stores, shapes, triggered='edit_control.geojson'))
+        selected = in_callback(home.select_stores, shapes, triggered='edit_control.geojson')
+        run(
+            f'get_stats selection {name} cold',
+            lambda: in_callback(home.get_stats, store, selected, triggered='selected_stores.data'),
+            clear
+        )
+
+    for mode, size in (('radius', 50), ('radius', 500), ('k', 500)):
+        run(
+            f'compare_with_neighbors {mode}={size} cold',
+            lambda: in_callback(
+                home.compare_with_neighbors, store, None, '2021Q1', mode, size, triggered='compare_mode.value'
+            ),
+            clear
+        )
+    return results
+
+
+def compare(results, previous, threshold):
+    """function prints the ratio of the minimums to an earlier result, returns the names of the regressions"""
+    regressions = []
+    for scale, benchmarks in results['results'].items():
+        for name, result in benchmarks.items():
+            old = previous.get('results', {}).get(scale, {}).get(name)
+            if not old or not old['min']:
+                continue
+            ratio = result['min'] / old['min']
+            flag = ''
+            if ratio > threshold and result['min'] - old['min'] > MIN_DIFFERENCE:
+                flag = '  <-- slower'
+                regressions.append(f'{scale} {name}')
+            print(f'{scale:>5} {name:<45} {old["min"]:>10.4f}s {result["min"]:>10.4f}s {ratio:>6.2f}x{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of the liquor app on synthetic data')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1], help='e.g. 1 10 100')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--stores', type=int, default=20, help='number of stores queried per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=DATA_DIR, help='directory of the generated csv files')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='json file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    # the data is only prepared when the benchmarks of a scale ask for the Dataset, importing
+    # the app does not read it. The source of the first scale is set for the app anyway
+    os.environ['LIQUOR_DATA_SOURCE'] = data_path(args.data_dir, args.scales[0], args.seed)
+    os.environ.setdefault('LIQUOR_CACHE_DIR', os.path.join(args.data_dir, 'cache'))
+
+    import app
+    import utils
+    from pages import home
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'sql_backend': utils.SQL_BACKEND,
+        },
+        'results': {},
+    }
+
+    for scale in args.scales:
+        path = data_path(args.data_dir, scale, args.seed)
+        print(f'benchmarks {scale:g}x', file=sys.stderr)
+
+        # the data of this scale becomes the Dataset of the app
+        utils.DATA_SOURCE = path
+        dataset = utils.get_dataset(refresh=True)
+        rng = np.random.default_rng(args.seed)
+        stores = rng.choice(dataset.stores.numbers, min(args.stores, len(dataset.stores.numbers)), replace=False)
+
+        benchmarks = {}
+        benchmarks.update(bench_prepare(utils, path, args.repeat))
+        benchmarks.update(bench_indexes(utils, dataset, stores, args.repeat))
+        benchmarks.update(bench_callbacks(app.app, utils, home, stores, args.repeat))
+        results['results'][f'{scale:g}x'] = benchmarks
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks are slower than {args.threshold}x', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+report of the start of the app: the import time of the modules (python -X importtime) and the
+time until the server answers the first request, e.g.
+
+    python benchmarks/startup.py --top 25
+
+The app is started in a fresh python process for every run. The data is not prepared on
+import (see app.py), so it is not part of the measurement.
+"""
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imports the app and requests the page, prints the seconds since the start of the process
+PROBE = '''
+import json
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.server.test_client().get('/')
+first_byte = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_byte": first_byte - start, "status": response.status_code}))
+'''
+
+
+def run_probe(code):
+    """function runs code in a new python process in the directory of the app, returns stdout and stderr"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return process.stdout, process.stderr
+
+
+def parse_importtime(stderr):
+    """function returns the import time (seconds) of every module: (depth, name) -> (self, cumulative)"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        # the indentation is the depth in the tree of the imports
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[depth, name.strip()] = (int(own) / 1e6, int(cumulative) / 1e6)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import time and time to first byte of the app')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=30, help='number of modules in the report')
+    parser.add_argument('--output', help='write the report to this json file')
+    args = parser.parse_args()
+
+    runs = []
+    imports = {}
+    for _ in range(args.repeat):
+        stdout, stderr = run_probe(PROBE)
+        runs.append(json.loads(stdout.strip().splitlines()[-1]))
+        for module, seconds in parse_importtime(stderr).items():
+            imports.setdefault(module, []).append(seconds)
+
+    # the modules with the longest import time (including the modules they import)
+    modules = sorted(
+        ((name, depth, *np.median(seconds, axis=0).tolist()) for (depth, name), seconds in imports.items()),
+        key=lambda module: -module[3]
+    )
+    report = {
+        'import_seconds': round(float(np.median([run['import'] for run in runs])), 3),
+        'first_byte_seconds': round(float(np.median([run['first_byte'] for run in runs])), 3),
+        'modules': [
+            {'name': name, 'depth': depth, 'self_seconds': round(own, 4), 'seconds': round(cumulative, 4)}
+            for name, depth, own, cumulative in modules[:args.top]
+        ],
+    }
+
+    print(f'import app: {report["import_seconds"]}s, first byte: {report["first_byte_seconds"]}s')
+    print(f'{"module":<45} {"depth":>5} {"self":>8} {"total":>8}')
+    for module in report['modules']:
+        print(f'{module["name"]:<45} {module["depth"]:>5} {module["self_seconds"]:>8} {module["seconds"]:>8}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
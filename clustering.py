@@ -0,0 +1,137 @@
+import numpy as np
+import json
+import math
+
+# stores closer than this number of pixels are combined into a cluster
+RADIUS = 80
+
+# clusters are precomputed up to this zoom level, at higher zoom levels all stores are shown
+MAX_ZOOM = 14
+
+TILE_SIZE = 256
+
+# the map can not show latitudes beyond this value (web mercator)
+MAX_LAT = 85.0511
+
+
+def project(lat, lon, zoom):
+    """function returns the pixel coordinates (web mercator) of lat, lon at a zoom level"""
+    scale = TILE_SIZE * 2 ** zoom
+    x = (lon + 180) / 360 * scale
+    sin = np.sin(np.radians(np.clip(lat, -MAX_LAT, MAX_LAT)))
+    y = (0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)) * scale
+    return x, y
+
+
+def snap_bounds(bounds, zoom):
+    """
+    function converts the bounds of the map [[south, west], [north, east]] into a bounding box
+    (west, south, east, north) which is snapped to the tile grid of the zoom level and padded
+    by one tile. Small movements of the map result in the same bounding box, so the response
+    can be cached.
+    """
+    step = 360 / 2 ** zoom
+    (south, west), (north, east) = bounds
+    west = max(-180.0, (math.floor(west / step) - 1) * step)
+    south = max(-90.0, (math.floor(south / step) - 1) * step)
+    east = min(180.0, (math.ceil(east / step) + 1) * step)
+    north = min(90.0, (math.ceil(north / step) + 1) * step)
+    return west, south, east, north
+
+
+def abbreviate(count):
+    """function returns the abbreviated number of stores of a cluster, e.g. 1.2k"""
+    if count >= 1000:
+        return f'{count / 1000:.1f}k'
+    return str(count)
+
+
+# Class for the clusters of the store markers. The stores are combined into clusters by
+# a grid of RADIUS pixels for every zoom level up to MAX_ZOOM when the data is prepared,
+# a query returns only the clusters (and single stores) within the bounding box. The pixel
+# coordinates double with every zoom level, so a cell of the grid is split into four cells of
+# the next level and every cluster has a parent cluster one level below.
+class ClusterIndex:
+    def __init__(self, numbers, coordinates, radius=RADIUS, max_zoom=MAX_ZOOM):
+        self.radius = radius
+        self.max_zoom = max_zoom
+        numbers = np.asarray(numbers, dtype=np.int64)
+        lat = np.asarray(coordinates[:, 0], dtype=np.float64)
+        lon = np.asarray(coordinates[:, 1], dtype=np.float64)
+
+        # one entry per zoom level: arrays lat, lon, count, store number (-1 for clusters) and the
+        # zoom level at which the cluster falls apart
+        levels = [self._cluster(numbers, lat, lon, zoom) for zoom in range(max_zoom + 1)]
+        self.levels = [level for level, _ in levels]
+        self.points = {'lat': lat, 'lon': lon, 'count': np.ones(len(numbers), dtype=np.int64), 'number': numbers}
+
+        # above MAX_ZOOM all stores are shown. Below, a cluster falls apart at the next level if it
+        # has more than one child cluster there, otherwise at the same level as its only child
+        self.levels[-1]['expansion_zoom'] = np.full(len(self.levels[-1]['count']), max_zoom + 1)
+        for zoom in range(max_zoom - 1, -1, -1):
+            level, child = self.levels[zoom], self.levels[zoom + 1]
+            # the parent of every child cluster is the cluster of its first store
+            parent = levels[zoom][1][child['first']]
+            expansion_zoom = np.empty(len(level['count']), dtype=np.int64)
+            expansion_zoom[parent] = child['expansion_zoom']
+            expansion_zoom[np.bincount(parent, minlength=len(level['count'])) > 1] = zoom + 1
+            level['expansion_zoom'] = expansion_zoom
+
+    def _cluster(self, numbers, lat, lon, zoom):
+        # the grid cell of every store
+        x, y = project(lat, lon, zoom)
+        cells = np.stack([np.floor(x / self.radius), np.floor(y / self.radius)], axis=1).astype(np.int64)
+        _, first, inverse, count = np.unique(cells, axis=0, return_index=True, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+
+        # the center of a cluster is the mean location of its stores
+        level = {
+            'lat': np.bincount(inverse, weights=lat) / count,
+            'lon': np.bincount(inverse, weights=lon) / count,
+            'count': count,
+            'number': np.where(count == 1, numbers[first], -1),
+            'first': first,
+        }
+        return level, inverse
+
+    def level(self, zoom):
+        """function returns the clusters of a zoom level"""
+        zoom = max(0, int(zoom))
+        return self.levels[zoom] if zoom <= self.max_zoom else self.points
+
+    def query(self, bbox, zoom):
+        """function returns the GeoJSON features of all clusters and stores within the bbox (west, south, east, north)"""
+        west, south, east, north = bbox
+        level = self.level(zoom)
+        lat, lon = level['lat'], level['lon']
+        idx = np.flatnonzero((lat >= south) & (lat <= north) & (lon >= west) & (lon <= east))
+
+        # clicking a cluster zooms in to the level at which the cluster falls apart (no clusters above MAX_ZOOM)
+        expansion_zoom = level['expansion_zoom'][idx] if 'expansion_zoom' in level else np.zeros(len(idx), dtype=np.int64)
+
+        features = []
+        for lat, lon, count, number, expansion in zip(
+                lat[idx].round(5).tolist(),
+                lon[idx].round(5).tolist(),
+                level['count'][idx].tolist(),
+                level['number'][idx].tolist(),
+                expansion_zoom.tolist()
+        ):
+            if count == 1:
+                properties = {'id': str(number), 'tooltip': str(number)}
+            else:
+                properties = {
+                    'cluster': True,
+                    'point_count': count,
+                    'point_count_abbreviated': abbreviate(count),
+                    'expansion_zoom': expansion,
+                }
+            features.append(
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]}, 'properties': properties}
+            )
+        return features
+
+    def geojson(self, bbox, zoom):
+        """function returns the GeoJSON (as bytes) of the query"""
+        geojson = {'type': 'FeatureCollection', 'features': self.query(bbox, zoom)}
+        return json.dumps(geojson, separators=(',', ':')).encode()
@@ -0,0 +1,68 @@
+from flask import Blueprint, Response, jsonify, request
+import gzip
+
+import metrics
+import utils
+
+# additional routes of the flask server, registered in app.py
+blueprint = Blueprint('endpoints', __name__)
+
+# browsers and proxies may reuse the clusters for this many seconds without asking again,
+# afterwards the ETag makes the request cheap (304 Not Modified)
+GEOJSON_MAX_AGE = 300
+
+
+# liveness check for load balancers, the server answers requests
+@blueprint.route('/health')
+def health():
+    return jsonify(status='ok')
+
+
+# readiness check for load balancers, 503 until the data has been prepared. The body
+# contains the current stage and the duration of the finished stages. If the data is not
+# prepared yet (or the preparation failed), the check starts the preparation, see warm_up
+@blueprint.route('/ready')
+def ready():
+    progress = utils.progress_snapshot()
+    if not progress['ready'] and progress['stage'] in ('waiting', 'failed'):
+        utils.warm_up()
+    return jsonify(progress), 200 if progress['ready'] else 503
+
+
+# metrics for Prometheus: data preparation, figure cache, compression and (with
+# LIQUOR_METRICS=1) the duration and payload sizes of every callback
+@blueprint.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# the clusters of the store markers within a bounding box at a zoom level,
+# e.g. /data/clusters.geojson?zoom=5&bbox=-98.4,39.3,-87.2,45.0
+@blueprint.route('/data/clusters.geojson')
+def clusters_geojson():
+    try:
+        zoom = int(request.args['zoom'])
+        west, south, east, north = map(float, request.args['bbox'].split(','))
+    except (KeyError, ValueError):
+        return Response('zoom and bbox=west,south,east,north are required', status=400)
+
+    dataset = utils.get_dataset()
+    use_gzip = 'gzip' in request.accept_encodings
+
+    # the ETag depends on the stores and the query only, a cached response is not computed again
+    etag = f'{dataset.stores.etag}-{zoom}-{west},{south},{east},{north}' + ('-gzip' if use_gzip else '')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        geojson = dataset.clusters.geojson((west, south, east, north), zoom)
+        if use_gzip:
+            response = Response(gzip.compress(geojson), mimetype='application/geo+json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(geojson, mimetype='application/geo+json')
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = GEOJSON_MAX_AGE
+    return response
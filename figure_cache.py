@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import os
+
+# limits of the cache, can be changed with environment variables
+MAX_ENTRIES = int(os.environ.get('LIQUOR_FIGURE_CACHE_ENTRIES', 256))
+MAX_MB = float(os.environ.get('LIQUOR_FIGURE_CACHE_MB', 64))
+
+# estimated length of the json of the layout of a figure, most of it is the template
+LAYOUT_BYTES = 7 * 1024
+
+
+def json_size(value):
+    """function returns the estimated length of the json of a property of a trace, e.g. of an array"""
+    if isinstance(value, np.ndarray):
+        # plotly sends numeric arrays base64 encoded, other arrays (e.g. dates) as text
+        if value.dtype.kind in 'biuf':
+            return 4 * value.nbytes // 3 + 32
+        return 24 * value.size
+    if isinstance(value, dict):
+        return sum(len(key) + 4 + json_size(item) for key, item in value.items()) + 2
+    if isinstance(value, (list, tuple)):
+        return sum(json_size(item) + 1 for item in value) + 2
+    if isinstance(value, str):
+        return len(value) + 2
+    return 8
+
+
+def estimate_size(fig):
+    """
+    function returns the estimated length of the json of a figure, i.e. the layout and the
+    lengths of the arrays of the traces. It is much cheaper than fig.to_json(), which would
+    encode the figure once more (dash encodes it again for the response).
+    """
+    return LAYOUT_BYTES + sum(json_size(trace.to_plotly_json()) for trace in fig.data)
+
+
+# Class for a cache of rendered plotly figures with least recently used eviction.
+# The size of a figure is the estimated length of its json, i.e. roughly the bytes sent to the browser.
+class FigureCache:
+    def __init__(self, max_entries=MAX_ENTRIES, max_mb=MAX_MB):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # time spent creating the figures of the misses
+        self.create_seconds = 0.0
+
+    def __len__(self):
+        return len(self._figures)
+
+    def get_or_create(self, key, create):
+        """
+        function returns the cached figure of the key. If there is none, the figure
+        is created by calling create() and put into the cache.
+        """
+        with self._lock:
+            entry = self._figures.get(key)
+            if entry is not None:
+                self._figures.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # create the figure outside of the lock, other sessions must not wait for it
+        start = time.perf_counter()
+        fig = create()
+        seconds = time.perf_counter() - start
+        size = estimate_size(fig)
+
+        with self._lock:
+            self.create_seconds += seconds
+            if size > self.max_bytes or self.max_entries <= 0:
+                return fig
+            old = self._figures.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._figures[key] = (fig, size)
+            self.bytes += size
+
+            # remove the least recently used figures
+            while len(self._figures) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, old_size) = self._figures.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+        return fig
+
+    def clear(self):
+        """function removes all figures, e.g. if the data has been prepared again"""
+        with self._lock:
+            self._figures.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """function returns the counters of the cache"""
+        with self._lock:
+            return {
+                'entries': len(self._figures),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'create_seconds': self.create_seconds,
+            }
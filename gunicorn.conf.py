@@ -0,0 +1,34 @@
+# configuration for running the app with several worker processes:
+#
+#     gunicorn app:server
+#
+# The app and the data are loaded once in the master process before the workers are
+# forked. The workers share the memory of the data (copy on write), so the memory of
+# a worker does not grow with the number of workers.
+import multiprocessing
+import gc
+import os
+
+bind = os.environ.get('LIQUOR_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('LIQUOR_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('LIQUOR_THREADS', 4))
+
+# import app.py in the master process instead of every worker
+preload_app = True
+
+
+def when_ready(server):
+    # prepare the data in the master process, i.e. before the workers are forked. The thread of
+    # warm_up is joined, so that no lock of the preparation (e.g. of the Dataset or the figure
+    # cache) is held while the workers are forked, a forked worker could never acquire it
+    import utils
+    utils.warm_up().join()
+    progress = utils.progress_snapshot()
+    if not progress['ready']:
+        server.log.error('data preparation failed, the workers prepare the data themselves: %s', progress['error'])
+        return
+
+    # move all objects into the permanent generation, otherwise the garbage collector of
+    # the workers writes into (and copies) every page which contains a python object
+    gc.freeze()
+    server.log.info('data prepared, workers share the data of the master process')
@@ -0,0 +1,150 @@
+from flask import g, request
+import threading
+import time
+import os
+
+import transport
+import utils
+
+# timing of the callbacks, disabled unless LIQUOR_METRICS=1. If disabled, no code runs per request,
+# /metrics only shows the values which exist anyway (data preparation, figure cache)
+ENABLED = os.environ.get('LIQUOR_METRICS', '') not in ('', '0')
+
+# upper bounds (seconds) of the buckets of the latency histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CALLBACK_PATH = '/_dash-update-component'
+
+_lock = threading.Lock()
+# one entry per callback (its output): count, seconds, bytes and the histogram counts
+_callbacks = {}
+# the callbacks of the app by output (app.callback_map), requests of other outputs are
+# recorded as 'unknown', so clients can not add labels
+_callback_map = {}
+
+
+def init_app(server, callback_map):
+    """
+    function registers the timing of the callbacks at the flask server, if enabled. callback_map
+    is the app.callback_map, which dash fills when the first request is handled
+    """
+    global _callback_map
+    _callback_map = callback_map
+    if ENABLED:
+        server.before_request(start_timer)
+        server.after_request(record_callback)
+
+
+def start_timer():
+    if request.path.endswith(CALLBACK_PATH):
+        g.metrics_start = time.perf_counter()
+
+
+def record_callback(response):
+    """function records the wall time and the size of request and response of a callback"""
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+
+    body = request.get_json(silent=True) or {}
+    name = body.get('output')
+    if not isinstance(name, str) or name not in _callback_map:
+        name = 'unknown'
+    request_bytes = request.content_length or 0
+    response_bytes = 0 if response.direct_passthrough else len(response.get_data())
+    record(name, seconds, request_bytes, response_bytes, response.status_code)
+    return response
+
+
+def record(name, seconds, request_bytes, response_bytes, status=200):
+    """function adds a call of the callback name to the metrics"""
+    with _lock:
+        entry = _callbacks.get(name)
+        if entry is None:
+            entry = _callbacks[name] = {
+                'count': 0, 'errors': 0, 'seconds': 0.0,
+                'request_bytes': 0, 'response_bytes': 0, 'buckets': [0] * len(BUCKETS)
+            }
+        entry['count'] += 1
+        entry['errors'] += status >= 500
+        entry['seconds'] += seconds
+        entry['request_bytes'] += request_bytes
+        entry['response_bytes'] += response_bytes
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry['buckets'][i] += 1
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _metric(lines, name, kind, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+    for suffix, labels, value in samples:
+        labels = ','.join(f'{key}="{_label(label)}"' for key, label in labels.items())
+        lines.append(f'{name}{suffix}{{{labels}}} {value}' if labels else f'{name}{suffix} {value}')
+
+
+def render():
+    """function returns all metrics in the text format of Prometheus"""
+    lines = []
+
+    # data preparation
+    progress = utils.progress_snapshot()
+    _metric(lines, 'liquor_data_ready', 'gauge', 'The data has been prepared.', [('', {}, int(progress['ready']))])
+    _metric(
+        lines, 'liquor_prepare_stage_seconds', 'gauge', 'Duration of the stages of the data preparation.',
+        [('', {'stage': stage}, seconds) for stage, seconds in progress['seconds'].items()]
+    )
+
+    # figure cache
+    cache = utils.figure_cache.stats()
+    _metric(lines, 'liquor_figure_cache_entries', 'gauge', 'Figures in the cache.', [('', {}, cache['entries'])])
+    _metric(lines, 'liquor_figure_cache_bytes', 'gauge', 'Size of the figures in the cache.', [('', {}, cache['bytes'])])
+    for key in ('hits', 'misses', 'evictions'):
+        _metric(lines, f'liquor_figure_cache_{key}_total', 'counter', f'Figure cache {key}.', [('', {}, cache[key])])
+    _metric(
+        lines, 'liquor_figure_create_seconds_total', 'counter', 'Time spent creating figures on cache misses.',
+        [('', {}, round(cache['create_seconds'], 6))]
+    )
+
+    # compression of the responses
+    compression = transport.stats()
+    _metric(lines, 'liquor_compressed_responses_total', 'counter', 'Compressed responses.', [('', {}, compression['compressed'])])
+    _metric(
+        lines, 'liquor_compression_bytes_total', 'counter', 'Size of the compressed responses.',
+        [('', {'direction': 'in'}, compression['bytes_in']), ('', {'direction': 'out'}, compression['bytes_out'])]
+    )
+    _metric(
+        lines, 'liquor_compression_seconds_total', 'counter', 'Time spent compressing responses.',
+        [('', {}, round(compression['seconds'], 6))]
+    )
+
+    # callbacks
+    with _lock:
+        callbacks = {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in _callbacks.items()}
+
+    samples = []
+    for name, entry in sorted(callbacks.items()):
+        for bound, count in zip(BUCKETS, entry['buckets']):
+            samples.append(('_bucket', {'callback': name, 'le': bound}, count))
+        samples.append(('_bucket', {'callback': name, 'le': '+Inf'}, entry['count']))
+        samples.append(('_sum', {'callback': name}, round(entry['seconds'], 6)))
+        samples.append(('_count', {'callback': name}, entry['count']))
+    _metric(lines, 'liquor_callback_seconds', 'histogram', 'Wall time of the callbacks including serialization.', samples)
+    _metric(
+        lines, 'liquor_callback_errors_total', 'counter', 'Callbacks which failed with a server error.',
+        [('', {'callback': name}, entry['errors']) for name, entry in sorted(callbacks.items())]
+    )
+    _metric(
+        lines, 'liquor_callback_request_bytes_total', 'counter', 'Size of the callback requests.',
+        [('', {'callback': name}, entry['request_bytes']) for name, entry in sorted(callbacks.items())]
+    )
+    _metric(
+        lines, 'liquor_callback_response_bytes_total', 'counter', 'Size of the callback responses before compression.',
+        [('', {'callback': name}, entry['response_bytes']) for name, entry in sorted(callbacks.items())]
+    )
+    return '\n'.join(lines) + '\n'
@@ -1,17 +1,25 @@
 import dash
+from dash import Patch, ctx
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
-from dash_extensions.enrich import ServersideOutput, Output, State, Input, callback, html, dcc
+from dash_extensions.enrich import Output, State, Input, callback, html, dcc
+from dash_extensions.javascript import Namespace
 
 import plotly.graph_objects as go
+import numpy as np
 
-import pandas as pd
-import json
+import clustering
 import utils
 
 dash.register_page(__name__, path="/", top_nav=True)
 
+# javascript functions in assets/20_clusters.js
+ns = Namespace('dashExtensions', 'default')
+
+# zoom level of the map at start
+ZOOM = 5
+
 
 layout = dbc.Container([
     dbc.Row([
@@ -19,18 +27,16 @@ layout = dbc.Container([
             html.Div(
                 id='geomap'
             ),
-            dcc.Store(
-                id='store_gb',
-            ),
             dcc.Store(
                 id='store_id'
             ),
+            # store numbers of the stores within the shapes drawn on the map
             dcc.Store(
-                id='serverside_store',
+                id='selected_stores'
             ),
-            html.Div(
-                id='dummy',
-                style={'display': None}
+            dcc.Interval(
+                id='ready_poll',
+                interval=1000
             )
         ],
             width=5
@@ -69,6 +75,31 @@ layout = dbc.Container([
                                 ), style={'width': '50%'}
                             )
                         ], className='d-flex align-items-center'),
+                        dbc.Row([
+                            html.Div(
+                                dbc.RadioItems(
+                                    id='compare_mode',
+                                    options=[
+                                        {'label': 'Nearest stores', 'value': 'neighbors'},
+                                        {'label': 'Stores within km', 'value': 'radius'},
+                                        {'label': 'k nearest stores', 'value': 'k'},
+                                    ],
+                                    value='neighbors',
+                                    inline=True
+                                ), style={'width': '50%'}
+                            ),
+                            html.Div(
+                                # radius in km or number of stores of the regional comparison
+                                dcc.Slider(
+                                    id='region_size',
+                                    min=10,
+                                    max=500,
+                                    step=10,
+                                    value=50,
+                                    marks={size: str(size) for size in (10, 100, 200, 300, 400, 500)},
+                                ), style={'width': '50%'}
+                            )
+                        ], className='d-flex align-items-center'),
                         dbc.Row(
                             dcc.Graph(
                                 id='graph_2',
@@ -84,24 +115,33 @@ layout = dbc.Container([
 ], fluid=True)
 
 
-# this callback gets triggered only at app start by a dummy component which is always hidden
-# I did this, because I could not figure out, how to initiate the serverside store with initial
-# values, i.e. data!=None
+# this callback gets triggered at page load and by the interval until the data is ready, in the
+# meantime a placeholder is shown. The data itself is prepared in the background and shared by all
+# sessions (and worker processes, see gunicorn.conf.py), nothing is stored per session
 @callback(
-    [
-        ServersideOutput('serverside_store', 'data'),
-        Output('geomap', 'children'),
-        Output('store_gb', 'data'),
-    ],
-    Input('dummy', 'children'),
+    Output('geomap', 'children'),
+    Output('ready_poll', 'disabled'),
+    Input('ready_poll', 'n_intervals'),
     prevent_initial_call=False
 )
 def prepare_date(_):
-    # prepare data
-    gb_store_number, kdt, markers = utils.prepare_data()
+    progress = utils.progress_snapshot()
+    if not progress['ready']:
+        # e.g. the app has been started without warm up or the preparation failed, the retries
+        # after a failure are limited by warm_up
+        if progress['stage'] in ('waiting', 'failed'):
+            utils.warm_up()
+        placeholder = html.Div(
+            [
+                dbc.Spinner(color='primary'),
+                html.P(f"Preparing data: {progress['stage']}", className='mt-3'),
+            ],
+            className='d-flex flex-column align-items-center justify-content-center',
+            style={'width': '100%', 'height': '800px'}
+        )
+        return placeholder, False
 
-    # this is actually a pandas.DataFrame.groupby(store_number) stored in a json format
-    gb = json.loads(gb_store_number)
+    dataset = utils.get_dataset()
 
     # create html.Div for the map
     g_map = html.Div(
@@ -115,22 +155,35 @@ def prepare_date(_):
                     ),
                     dl.GeoJSON(
                         id='liquor_stores',
-                        data=utils.dicts_to_geojson(
-                            [{**marker, **dict(tooltip=marker['id'])} for marker in markers]
-                        ),
-                        cluster=True,
-                        zoomToBoundsOnClick=True,
-                        superClusterOptions={"radius": 80}
+                        # the clusters are created on the server and loaded from a route, see
+                        # endpoints.py. The url is updated whenever the map is moved.
+                        url=clusters_url([[-90, -180], [90, 180]], ZOOM),
+                        options=dict(pointToLayer=ns('pointToLayer')),
+                    ),
+                    # rectangles and polygons drawn on the map select the stores within
+                    dl.FeatureGroup(
+                        dl.EditControl(
+                            id='edit_control',
+                            position='topleft',
+                            draw=dict(
+                                rectangle=True,
+                                polygon=True,
+                                polyline=False,
+                                circle=False,
+                                circlemarker=False,
+                                marker=False
+                            )
+                        )
                     )
                 ],
                 style={'width': '100%', 'height': '800px'},
                 # center the view on the first store location
-                center=[markers[0].get('lat'), markers[0].get('lon')],
-                zoom=5,
+                center=dataset.stores.coordinates[0].tolist(),
+                zoom=ZOOM,
             )
         ]
     )
-    return kdt, g_map, gb
+    return g_map, True
 
 
 # callback triggers the click feature on the map, if a marker is clicked, return its ID
@@ -141,45 +194,157 @@ def prepare_date(_):
 def liquor_store_id(feature):
     if not feature:
         raise PreventUpdate
-    # this is necessary if a click_feature is fired but no marker has been clicked
+    # this is necessary if a click_feature is fired but no marker has been clicked (e.g. a cluster)
     if not feature.get('properties').get('id'):
         raise PreventUpdate
     return feature['properties']['id']
 
 
+# callback loads the clusters and stores within the visible part of the map whenever the
+# map is moved or zoomed
+@callback(
+    Output('liquor_stores', 'url'),
+    Input('basemap', 'bounds'),
+    Input('basemap', 'zoom'),
+    prevent_initial_call=True
+)
+def update_clusters(bounds, zoom):
+    if not bounds or zoom is None:
+        raise PreventUpdate
+    return clusters_url(bounds, zoom)
+
+
+# callback zooms into a cluster if a cluster is clicked
+@callback(
+    Output('basemap', 'viewport'),
+    Input('liquor_stores', 'click_feature'),
+    prevent_initial_call=True
+)
+def zoom_to_cluster(feature):
+    if not feature or not feature.get('properties', {}).get('cluster'):
+        raise PreventUpdate
+    lon, lat = feature['geometry']['coordinates']
+    return {'center': [lat, lon], 'zoom': feature['properties']['expansion_zoom']}
+
+
+# function returns the url of the clusters within the bounds [[south, west], [north, east]]
+def clusters_url(bounds, zoom):
+    zoom = int(round(zoom))
+    bbox = ','.join(f'{value:g}' for value in clustering.snap_bounds(bounds, zoom))
+    return dash.get_relative_path(f'/data/clusters.geojson?zoom={zoom}&bbox={bbox}')
+
+
+# callback selects the stores within the rectangles and polygons drawn on the map. If all
+# shapes are deleted (or they contain no store), the selection is cleared
+@callback(
+    Output('selected_stores', 'data'),
+    Input('edit_control', 'geojson'),
+    prevent_initial_call=True
+)
+def select_stores(geojson):
+    rings = [
+        feature['geometry']['coordinates'][0]
+        for feature in (geojson or {}).get('features', [])
+        if feature.get('geometry', {}).get('type') == 'Polygon'
+    ]
+    if not rings:
+        return None
+
+    dataset = utils.get_dataset()
+    selected = np.unique(np.concatenate([dataset.stores.in_polygon(ring) for ring in rings]))
+    return selected.tolist() or None
+
+
 # callback is triggerd by updating the data in the dcc.Store(id='store_id')
-# which basically means, a different store number has been clicked
-# updates the dcc.Graph(id='g1')
+# which basically means, a different store number has been clicked, or by
+# the selection of stores on the map. If the selection is cleared, the chart shows
+# the clicked store again. Updates the dcc.Graph(id='g1'), the stores
+# of the chart are kept in the dcc.Store(id='chart_stores') and the metrics of its
+# traces (in the order of the traces) in the dcc.Store(id='chart_metrics')
 @callback(
     Output('g1', 'children'),
     Input('store_id', 'data'),
-    State('store_gb', 'data'),
+    Input('selected_stores', 'data'),
     prevent_initial_call=True
 )
-def get_stats(store_id, store_gb):
-    # convert the json into a DataFrame
-    df_store_id = pd.read_json(store_gb[store_id])
+def get_stats(store_id, selected_stores):
+    if ctx.triggered_id == 'selected_stores' and selected_stores:
+        stores = selected_stores
+    else:
+        stores = [int(store_id)] if store_id else []
+    if not stores:
+        # neither a selection nor a clicked store
+        return []
 
-    # create figure and update layout
-    fig = go.Figure()
-    fig.add_bar(x=df_store_id.date, y=df_store_id.sale_dollars)
-    fig.update_layout(utils.figure_layout)
+    dataset = utils.get_dataset()
+    fig = utils.figure_cache.get_or_create(
+        ('store', dataset.version, tuple(stores), 'Daily', 'bar', ('sale_dollars',)),
+        lambda: store_figure(dataset, stores, ['sale_dollars'])
+    )
+
+    # the totals of the largest stores of a selection per quarter
+    breakdown = []
+    if len(stores) > 1:
+        breakdown = [
+            dbc.Row(
+                html.P(f'{len(stores)} stores selected, total sale per quarter of the largest stores', className='mt-2')
+            ),
+            dbc.Row(
+                dcc.Graph(
+                    id='graph_breakdown',
+                    figure=utils.figure_cache.get_or_create(
+                        ('breakdown', dataset.version, tuple(stores)),
+                        lambda: breakdown_figure(dataset, stores)
+                    )
+                )
+            )
+        ]
 
     return dbc.Container(
         [
+            dcc.Store(
+                id='chart_stores',
+                data=stores
+            ),
+            dcc.Store(
+                id='chart_metrics',
+                data=['sale_dollars']
+            ),
             dbc.Row(
                 html.Div(
-                    dcc.Dropdown(
-                        id='drop',
-                        options=[
-                            'bottles_sold',
-                            'sale_dollars',
-                            'volume_sold_liters'
-                        ],
-                        value='sale_dollars',
-                        multi=True,
-
-                    ), style={'width': '50%'}
+                    [
+                        html.Div(
+                            dcc.Dropdown(
+                                id='drop',
+                                options=[
+                                    'bottles_sold',
+                                    'sale_dollars',
+                                    'volume_sold_liters'
+                                ],
+                                value='sale_dollars',
+                                multi=True,
+
+                            ), style={'width': '50%'}
+                        ),
+                        dbc.RadioItems(
+                            id='resolution',
+                            options=list(utils.RESOLUTIONS),
+                            value='Daily',
+                            inline=True,
+                            className='ms-3'
+                        ),
+                        dbc.RadioItems(
+                            id='chart_type',
+                            options=[
+                                {'label': 'Bar', 'value': 'bar'},
+                                {'label': 'Line', 'value': 'line'}
+                            ],
+                            value='bar',
+                            inline=True,
+                            className='ms-3'
+                        ),
+                    ],
+                    className='d-flex align-items-center'
                 )
             ),
             dbc.Row(
@@ -187,39 +352,63 @@ def get_stats(store_id, store_gb):
                     id='graph_1',
                     figure=fig
                 )
-            )
+            ),
+            *breakdown
         ]
     )
 
 
 # this callback updates the figure of graph_1 depending on the selections of the
-# dropdown component right above
+# components right above. The figure only contains the traces of the selected metrics,
+# if only the selected metrics change, the traces of the removed metrics are deleted and
+# the traces of the added metrics are appended in the browser. The resolution and the
+# chart type change the figure, which is resampled on the server
 @callback(
-    Output('graph_1', 'figure'),
-    Input('drop', 'value'),
     [
-        State('store_id', 'data'),
-        State('store_gb', 'data')
+        Output('graph_1', 'figure'),
+        Output('chart_metrics', 'data')
     ],
+    Input('drop', 'value'),
+    Input('resolution', 'value'),
+    Input('chart_type', 'value'),
+    State('chart_stores', 'data'),
+    State('chart_metrics', 'data'),
     prevent_initial_call=True
 )
-def update_figure(drop_selection, store_id, store_gb):
-    # convert the json into a DataFrame
-    df_store_id = pd.read_json(store_gb[store_id])
+def update_figure(drop_selection, resolution, chart_type, stores, chart_metrics):
+    if isinstance(drop_selection, str):
+        drop_selection = [drop_selection]
+    drop_selection = drop_selection or []
+    dataset = utils.get_dataset()
 
-    # create figure and update layout
-    fig = go.Figure()
-    for selection in drop_selection:
-        fig.add_bar(x=df_store_id.date, y=df_store_id[selection], name=selection)
+    if ctx.triggered_id == 'drop' and chart_metrics is not None:
+        kept = [metric for metric in chart_metrics if metric in drop_selection]
+        added = [metric for metric in utils.METRICS if metric in drop_selection and metric not in chart_metrics]
+        patch = Patch()
+        # delete from the last trace, so the positions of the other traces do not change
+        for i in reversed(range(len(chart_metrics))):
+            if chart_metrics[i] not in drop_selection:
+                del patch['data'][i]
+        if added:
+            df_store_id = store_totals(dataset, stores, resolution)
+            for metric in added:
+                patch['data'].append(metric_trace(df_store_id, metric, chart_type))
+        return patch, kept + added
 
-    fig.update_layout(utils.figure_layout)
-    return fig
+    metrics = [metric for metric in utils.METRICS if metric in drop_selection]
+    fig = utils.figure_cache.get_or_create(
+        ('store', dataset.version, tuple(stores), resolution, chart_type, tuple(metrics)),
+        lambda: store_figure(dataset, stores, metrics, resolution, chart_type)
+    )
+    return fig, metrics
 
 
 # this callback shows the hidden dropdown (only at first selection of store)
 # and updates the figure depending on the number of neighbors chosen in the
 # dropdown right above the figure. Also takes into account the quarter chosen
-# by the radio item
+# by the radio item. If only the quarter changes, only the new x and y values of the
+# traces are sent to the browser. In the regional modes the store is compared with
+# all stores within a radius or its k nearest stores instead
 @callback(
     [
         Output('g2', 'style'),
@@ -229,46 +418,172 @@ def update_figure(drop_selection, store_id, store_gb):
         Input('store_id', 'data'),
         Input('drop_neighbors', 'value'),
         Input('radio_quarter', 'value'),
+        Input('compare_mode', 'value'),
+        Input('region_size', 'value'),
     ],
-    State('serverside_store', 'data'),
-    State('store_gb', 'data'),
     prevent_initial_call=True
 )
 def compare_with_neighbors(
         store_id,
         no_of_neighbors,
         quarter,
-        serverside_store,
-        store_gb
+        mode,
+        region_size
 ):
-    # retrieve information from server side store
-    kdt, store_objects, store_coord_dict = serverside_store
-
-    # get the location of the current store number
-    current_stor_loc = store_coord_dict.get(int(store_id))
+    if not store_id:
+        raise PreventUpdate
 
     # set default for number of neighbors
     if not no_of_neighbors:
         no_of_neighbors = 1
 
-    # query in KDTree for the current store location
-    dist, idx = kdt.query([current_stor_loc], no_of_neighbors)
+    dataset = utils.get_dataset()
+
+    if mode in ('radius', 'k'):
+        region_size = int(region_size or 50)
+        fig = utils.figure_cache.get_or_create(
+            ('region', dataset.version, int(store_id), mode, region_size, quarter),
+            lambda: region_figure(dataset, store_id, mode, region_size, quarter)
+        )
+        return {}, fig
+
+    # the stores of the traces do not change, swap the values of the traces
+    if ctx.triggered_id == 'radio_quarter':
+        neighbors, _ = dataset.stores.nearest(store_id, no_of_neighbors)
+        patch = Patch()
+        for i, neighbor in enumerate(neighbors):
+            df = dataset.totals(neighbor, quarter=quarter, metrics=['sale_dollars'])
+            patch['data'][i]['x'] = df.index
+            patch['data'][i]['y'] = df.sale_dollars.to_numpy()
+        return dash.no_update, patch
+
+    fig = utils.figure_cache.get_or_create(
+        ('neighbors', dataset.version, int(store_id), no_of_neighbors, quarter),
+        lambda: neighbors_figure(dataset, store_id, no_of_neighbors, quarter)
+    )
+    return {}, fig
+
+
+# function returns the totals of a store (or of several stores together) per day (or week,
+# month, quarter)
+def store_totals(dataset, stores, resolution='Daily'):
+    # get the daily totals of the stores from the shared data, sum them per period
+    df_totals = dataset.totals(stores[0]) if len(stores) == 1 else dataset.selection_totals(stores)
+    return utils.resample(df_totals, utils.RESOLUTIONS[resolution])
+
+
+# function creates the trace of a metric of the totals. Lines are downsampled to
+# utils.MAX_POINTS points, so the size of the trace does not depend on the number of days
+def metric_trace(df_store_id, metric, chart_type='bar'):
+    if chart_type == 'line':
+        idx = utils.lttb(df_store_id.index, df_store_id[metric], utils.MAX_POINTS)
+        return go.Scatter(
+            x=df_store_id.index[idx],
+            y=df_store_id[metric].to_numpy()[idx],
+            mode='lines',
+            name=metric
+        )
+    return go.Bar(
+        x=df_store_id.index,
+        y=df_store_id[metric],
+        name=metric
+    )
+
+
+# function creates the figure of the totals of a store (or of several stores together) with
+# a trace for every selected metric, in the order of utils.METRICS
+def store_figure(dataset, stores, metrics, resolution='Daily', chart_type='bar'):
+    df_store_id = store_totals(dataset, stores, resolution)
+
+    # create figure and update layout
+    fig = go.Figure([
+        metric_trace(df_store_id, metric, chart_type) for metric in utils.METRICS if metric in metrics
+    ])
+    utils.register_template()
+    fig.update_layout(utils.figure_layout)
+    return fig
+
+
+# function creates the figure of the total sale per quarter of the selected stores, the largest
+# stores are shown separately and the other stores together
+def breakdown_figure(dataset, stores, top=10):
+    df = dataset.quarterly_breakdown(stores, 'sale_dollars')
+    largest = df.sum(axis=1).sort_values(ascending=False, kind='stable').index[:top]
+
+    # create base figure, one stacked bar per store
+    fig = go.Figure()
+    for store_number in largest:
+        fig.add_bar(x=df.columns, y=df.loc[store_number], name=f'id:{store_number}')
+    if len(df) > len(largest):
+        fig.add_bar(x=df.columns, y=df.drop(largest).sum(), name=f'{len(df) - len(largest)} other stores')
+
+    utils.register_template()
+    fig.update_layout(utils.figure_layout)
+    fig.update_layout({'barmode': 'stack', 'height': 300, 'yaxis': {'title': 'Total sale in USD'}})
+    return fig
 
-    # get the list of neighboring stores
-    neighbors = [store_objects[int(i)].num for i in idx[0]]
+
+# function creates the figure of the total sale of a store and its neighbors in a quarter
+def neighbors_figure(dataset, store_id, no_of_neighbors, quarter):
+    # get the list of neighboring stores from the precomputed neighbor table
+    neighbors, _ = dataset.stores.nearest(store_id, no_of_neighbors)
 
     # create base figure
     fig = go.Figure()
 
-    # get DataFrames, create traces
+    # get the daily totals of the quarter, create traces
     for neighbor in neighbors:
-        df = pd.read_json(store_gb[str(neighbor)])
-        df = df[df.quarter == quarter]
-        fig.add_bar(x=df.date, y=df.sale_dollars, name=f'id:{neighbor}')
+        df = dataset.totals(neighbor, quarter=quarter, metrics=['sale_dollars'])
+        fig.add_bar(x=df.index, y=df.sale_dollars, name=f'id:{neighbor}')
 
     # group the bar charts and change the layout
+    utils.register_template()
     fig.update_layout(utils.figure_layout)
 
     # add yaxis title
     fig.update_layout({'yaxis': {'title': 'Total sale in USD'}})
-    return {}, fig
+    return fig
+
+
+# function returns the ordinal number of n, e.g. 1st, 22nd, 13th
+def ordinal(n):
+    suffix = 'th' if 10 <= n % 100 <= 20 else {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return f'{n}{suffix}'
+
+
+# function creates the figure of the distribution of the total sale in a quarter of the stores in
+# the region of a store (within region_size km or the region_size nearest stores). The totals are
+# binned on the server, the size of the figure does not depend on the number of stores
+def region_figure(dataset, store_id, mode, region_size, quarter):
+    if mode == 'radius':
+        region = dataset.region(store_id, quarter, radius_km=region_size)
+        description = f'{len(region["values"])} stores within {region_size} km'
+    else:
+        region = dataset.region(store_id, quarter, k=region_size)
+        description = f'{len(region["values"])} nearest stores'
+
+    counts, edges = np.histogram(region['values'], bins=utils.REGION_BINS)
+
+    # create base figure, the bars are the number of stores per range of the total sale
+    fig = go.Figure()
+    fig.add_bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges), name='stores')
+
+    # interquartile range and median of the region, total sale of the store
+    fig.add_vrect(x0=region['q1'], x1=region['q3'], fillcolor='#00cc96', opacity=0.15, line_width=0)
+    fig.add_vline(x=region['median'], line_dash='dash', line_color='#00cc96')
+    fig.add_vline(x=region['value'], line_color='#EF553B')
+
+    utils.register_template()
+    fig.update_layout(utils.figure_layout)
+    fig.update_layout({
+        'title': {
+            'text': f'id:{store_id} is at the {ordinal(int(round(region["rank"])))} percentile of {description}, '
+                    f'median {region["median"]:,.0f} USD (IQR {region["q1"]:,.0f} - {region["q3"]:,.0f})',
+            'font': {'size': 13},
+        },
+        'margin': {'t': 40},
+        'xaxis': {'title': 'Total sale in USD'},
+        'yaxis': {'title': 'Number of stores'},
+        'showlegend': False,
+    })
+    return fig
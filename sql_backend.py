@@ -0,0 +1,187 @@
+from contextlib import suppress
+from pathlib import Path
+import pandas as pd
+import itertools
+import threading
+import tempfile
+import sqlite3
+import atexit
+import json
+import os
+
+
+def remove(path):
+    """function removes a file, if it exists"""
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+# Class for the transactions stored in a local SQLite file. The aggregations are done by
+# SQLite, only the result is loaded into a DataFrame. The file is created once from the
+# prepared chunks of the raw data, so the data does not need to fit into memory. The file is
+# the cache of the data source and is opened read only. Appended rows are written into a
+# temporary file of the process instead, every append gets a version and a SqlStore only
+# reads the rows of its versions. So an append returns a new SqlStore and does not change
+# the SqlStores (and Datasets) which use the file already.
+class SqlStore:
+    # counter for the versions of the appended rows
+    _versions = itertools.count(1)
+
+    def __init__(self, path, metrics, appended=None, versions=()):
+        self.path = path
+        # the names of the metrics are part of the queries, only these columns can be queried
+        self.metrics = list(metrics)
+        # temporary file of the appended rows and the versions of the appends of this SqlStore
+        self.appended = appended
+        self.versions = tuple(versions)
+        # sqlite connections must not be shared by threads, every thread opens its own connection
+        self._local = threading.local()
+
+    @classmethod
+    def build(cls, path, chunks, metrics):
+        """
+        function creates the SQLite file from the prepared chunks of the raw data (unless it
+        exists already) and returns the SqlStore of it.
+        """
+        if not os.path.isfile(path):
+            # write into a temporary file first, so that a concurrent reader never sees a partial file.
+            # A partial file of an earlier attempt of this process is removed, the rows would be added twice
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            remove(tmp_path)
+            try:
+                con = sqlite3.connect(tmp_path)
+                try:
+                    with con:
+                        for chunk in chunks:
+                            cls._insert(con, chunk)
+                        cls._create_indexes(con)
+                finally:
+                    con.close()
+                os.replace(tmp_path, path)
+            except BaseException:
+                remove(tmp_path)
+                raise
+        return cls(path, metrics)
+
+    @staticmethod
+    def _insert(con, df):
+        # dates are stored as text (YYYY-MM-DD), categories as their values
+        df = df.assign(date=df.date.dt.strftime('%Y-%m-%d'))
+        df.to_sql('transactions', con, if_exists='append', index=False)
+
+    @staticmethod
+    def _create_indexes(con):
+        con.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_store_quarter_date ON transactions (store_number, quarter, date);
+            CREATE INDEX IF NOT EXISTS idx_date ON transactions (date);
+            CREATE INDEX IF NOT EXISTS idx_quarter ON transactions (quarter);
+        ''')
+
+    @property
+    def connection(self):
+        con = getattr(self._local, 'connection', None)
+        if con is None:
+            # the file of the data source is never changed, the appended rows are in an attached file
+            con = sqlite3.connect(Path(self.path).resolve().as_uri() + '?mode=ro', uri=True)
+            if self.appended is not None:
+                con.execute('ATTACH DATABASE ? AS appended', [self.appended])
+            self._local.connection = con
+        return con
+
+    @property
+    def transactions(self):
+        """the table of the transactions in the queries, i.e. with the appended rows of this SqlStore"""
+        if not self.versions:
+            return 'transactions'
+        columns = ', '.join(['store_number', 'quarter', 'date'] + self.metrics)
+        # the versions are integers of the counter, not input of a user
+        versions = ', '.join(str(int(version)) for version in self.versions)
+        return f'''(
+            SELECT {columns} FROM main.transactions
+            UNION ALL
+            SELECT {columns} FROM appended.transactions WHERE version IN ({versions})
+        )'''
+
+    def query(self, sql, params=()):
+        """function returns the result of a parameterized query as DataFrame"""
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def locations(self):
+        """
+        function returns the location (lat, lon) of each store of the data source, i.e. the
+        location of its first row. The locations of appended rows are handled by Dataset.append.
+        """
+        return self.query('''
+            SELECT t.store_number, t.lat, t.lon
+            FROM transactions t
+            JOIN (SELECT store_number, MIN(rowid) AS first_row FROM transactions GROUP BY store_number) f
+            ON t.rowid = f.first_row
+            ORDER BY t.store_number
+        ''').set_index('store_number')
+
+    def totals(self, store_id, quarter=None, metrics=None):
+        """function returns the daily totals of a single store, see Dataset.totals"""
+        metrics = self.metrics if metrics is None else list(metrics)
+        unknown = set(metrics) - set(self.metrics)
+        if unknown:
+            raise ValueError(f'unknown metrics: {sorted(unknown)}')
+
+        sums = ', '.join(f'SUM({metric}) AS {metric}' for metric in metrics)
+        sql = f'SELECT date, {sums} FROM {self.transactions} WHERE store_number = ?'
+        params = [int(store_id)]
+        if quarter is not None:
+            sql += ' AND quarter = ?'
+            params.append(quarter)
+        sql += ' GROUP BY date ORDER BY date'
+
+        # round the totals to two decimals like Dataset.totals, integer totals are not changed
+        df = self.query(sql, params).round(2)
+        df['date'] = pd.to_datetime(df.date)
+        return df.set_index('date')
+
+    def selection_totals(self, store_numbers, metrics):
+        """function returns the daily totals of several stores together, see Dataset.selection_totals"""
+        unknown = set(metrics) - set(self.metrics)
+        if unknown:
+            raise ValueError(f'unknown metrics: {sorted(unknown)}')
+
+        # the store numbers are a single parameter (json array), there may be thousands of them
+        sums = ', '.join(f'SUM({metric}) AS {metric}' for metric in metrics)
+        df = self.query(
+            f'''
+            SELECT date, {sums} FROM {self.transactions}
+            WHERE store_number IN (SELECT value FROM json_each(?))
+            GROUP BY date ORDER BY date
+            ''',
+            [json.dumps([int(number) for number in store_numbers])]
+        ).round(2)
+        df['date'] = pd.to_datetime(df.date)
+        return df.set_index('date')
+
+    def quarterly_totals(self):
+        """function returns the totals of the metrics per store and quarter, index is (store_number, quarter)"""
+        sums = ', '.join(f'SUM({metric}) AS {metric}' for metric in self.metrics)
+        df = self.query(f'SELECT store_number, quarter, {sums} FROM {self.transactions} GROUP BY store_number, quarter')
+        return df.round(2).set_index(['store_number', 'quarter'])
+
+    def append(self, df):
+        """
+        function returns a new SqlStore with the prepared rows of df added. The rows are inserted
+        into the temporary file of the appended rows in a single transaction, this SqlStore
+        does not read them. The appended rows are lost when the process ends.
+        """
+        appended = self.appended
+        if appended is None:
+            fd, appended = tempfile.mkstemp(prefix='liquor_appended_', suffix='.sqlite')
+            os.close(fd)
+            atexit.register(remove, appended)
+
+        version = next(SqlStore._versions)
+        con = sqlite3.connect(appended)
+        try:
+            with con:
+                self._insert(con, df.assign(version=version))
+                self._create_indexes(con)
+        finally:
+            con.close()
+        return SqlStore(self.path, self.metrics, appended, self.versions + (version,))
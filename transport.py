@@ -0,0 +1,110 @@
+from flask import request
+import threading
+import time
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# compression of the responses of the flask server, disabled unless LIQUOR_COMPRESS=1.
+# It is usually done by a reverse proxy, this is for deployments without one
+COMPRESS = os.environ.get('LIQUOR_COMPRESS', '') not in ('', '0')
+
+# smaller responses are sent uncompressed, the compression would not pay off
+COMPRESS_MIN_BYTES = int(os.environ.get('LIQUOR_COMPRESS_MIN_BYTES', 1024))
+
+# fast levels, the responses are compressed for every request
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# only these types of responses are compressed
+COMPRESS_MIMETYPES = {
+    'application/json',
+    'application/geo+json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/javascript',
+    'text/plain',
+}
+
+# engine which serializes the figures and callback responses, e.g. LIQUOR_JSON_ENGINE=orjson.
+# Empty keeps the default of plotly (orjson if it is installed)
+JSON_ENGINE = os.environ.get('LIQUOR_JSON_ENGINE', '')
+
+_lock = threading.Lock()
+_stats = {
+    'compressed': 0,
+    'skipped': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
+    'seconds': 0.0,
+}
+
+
+def init_app(server):
+    """function sets the json engine and registers the compression of the responses at the flask server"""
+    if JSON_ENGINE:
+        import plotly.io as pio
+        pio.json.config.default_engine = JSON_ENGINE
+    if COMPRESS:
+        server.after_request(compress_response)
+
+
+def choose_encoding(accept_encodings):
+    """function returns the best encoding accepted by the client (br, gzip) or None"""
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    """function returns data compressed with the encoding (br or gzip)"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    """function compresses the body of the response, if it is large enough and the client accepts it"""
+    if (
+            response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        with _lock:
+            _stats['skipped'] += 1
+        return response
+
+    start = time.perf_counter()
+    body = compress(data, encoding)
+    seconds = time.perf_counter() - start
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    with _lock:
+        _stats['compressed'] += 1
+        _stats['bytes_in'] += len(data)
+        _stats['bytes_out'] += len(body)
+        _stats['seconds'] += seconds
+    return response
+
+
+def stats():
+    """function returns the counters of the compression"""
+    import plotly.io as pio
+    with _lock:
+        return dict(_stats, enabled=COMPRESS, json_engine=pio.json.config.default_engine)
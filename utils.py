@@ -1,137 +1,792 @@
-from sklearn.neighbors import KDTree
-import plotly.io as pio
+from figure_cache import FigureCache
+from clustering import ClusterIndex
+from sql_backend import SqlStore
+from pandas.api.types import union_categoricals
 import pandas as pd
-import re
+import numpy as np
+import itertools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+import tempfile
+import os
 
+# source of the raw data, either a local path or an URL. Can be changed with the
+# environment variable LIQUOR_DATA_SOURCE, e.g. if the host has no outbound network
+DATA_SOURCE = os.environ.get(
+    'LIQUOR_DATA_SOURCE',
+    'https://raw.githubusercontent.com/plotly/datasets/master/liquor_iowa_2021.csv'
+)
+
+# directory for the parquet cache of the prepared data, an empty string disables the cache
+CACHE_DIR = os.environ.get(
+    'LIQUOR_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+)
+
+# the transactions can be kept in a local SQLite file instead of memory (LIQUOR_SQL_BACKEND=sqlite),
+# the charts then query the file. This is useful if the data is larger than the memory.
+SQL_BACKEND = os.environ.get('LIQUOR_SQL_BACKEND', '')
+
+# number of threads which compute the daily totals, every thread sums the rows of a part of the stores
+PREPARE_WORKERS = int(os.environ.get('LIQUOR_PREPARE_WORKERS', os.cpu_count() or 1))
+
+# maximum number of bins (store and day) of the daily totals which a thread sums at once
+MAX_BINS = 1 << 22
+
+# metrics which can be shown in the graphs
+METRICS = ['bottles_sold', 'sale_dollars', 'volume_sold_liters']
+
+# maximum number of stores in the comparison with the neighbors (including the store itself)
+MAX_NEIGHBORS = 6
+
+# number of bins of the distribution chart of the regional comparison
+REGION_BINS = 30
+
+# mean radius of the earth in km, used to convert haversine distances
+EARTH_RADIUS_KM = 6371.0088
+
+# number of rows which are read at once
+CHUNK_SIZE = int(os.environ.get('LIQUOR_CHUNK_SIZE', 500_000))
 
-def prepare_data():
+# columns of the raw data which are used by the app, the other columns (e.g. the invoice
+# number, which is unique per row) are not read
+COLUMNS = ['date', 'store_number', 'store_location'] + METRICS
+
+# compact dtypes of the columns of the raw data
+DTYPES = {
+    'date': 'category',
+    'store_number': 'int32',
+    'bottles_sold': 'int32',
+    'sale_dollars': 'float32',
+    'volume_sold_liters': 'float32',
+}
+
+# resolutions of the store chart, the value is the rule of DataFrame.resample
+RESOLUTIONS = {'Daily': 'D', 'Weekly': 'W-MON', 'Monthly': 'MS', 'Quarterly': 'QS'}
+
+# line charts are downsampled to this number of points, about the width of the chart in pixels
+MAX_POINTS = int(os.environ.get('LIQUOR_MAX_POINTS', 800))
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# increase this number whenever the layout of the cached DataFrame changes
+CACHE_VERSION = 4
+
+
+def source_hash(source):
     """
-    function prepares the data for the app.
+    function returns a hash identifying the data source.
 
-    - read the raw data
-    - filter the DataFrame so that only stores remain which have a location
-    - create a KDTree for neighbor search
-    - create markers for map
-    - create a json which basically is a grouped DataFrame
+    For a local file the content is hashed, so that a changed file results in a new
+    cache entry. For an URL only the URL itself can be hashed.
     """
-    # read Raw data
-    df = pd.read_csv(
-        'https://raw.githubusercontent.com/plotly/datasets/master/liquor_iowa_2021.csv')
+    h = hashlib.sha256(f'v{CACHE_VERSION}:'.encode())
+    if os.path.isfile(source):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        h.update(source.encode())
+    return h.hexdigest()[:16]
 
-    # find stores without information concerning location and delete these stores
-    filt = df.store_location.isnull()
-    df = df.drop(df[filt].index)
 
-    # group by store_number
-    gb = df.groupby('store_number')
+def read_data(source, chunksize=None):
+    """
+    function reads the raw data in chunks and cleans / enriches it.
+
+    Every chunk is read with compact dtypes and only the columns in COLUMNS, the rows without
+    location are dropped before the next chunk is read. The prepared chunks are kept until
+    they are concatenated, so the memory peak is about twice the size of the prepared data
+    (but not the size of the raw text). See load_backend for a reader which does not keep
+    the chunks.
+    """
+    return clean_data(concat_chunks(list(read_chunks(source, chunksize))))
 
-    # create dataframe of locations
-    locations = gb.store_location.unique().to_frame()
 
-    coordinates = {}
-    for idx, row in zip(locations.index, locations.store_location):
-        # information is stored in an array, extract coordinate information
-        coords = re.search("\((.*)\)", row[0]).group(1)
+def read_chunks(source, chunksize=None):
+    """function yields the prepared chunks of the raw data, see parse_chunk"""
+    for chunk in pd.read_csv(source, usecols=COLUMNS, dtype=DTYPES, chunksize=chunksize or CHUNK_SIZE):
+        yield parse_chunk(chunk)
 
-        # convert string into float
-        lon, lat = map(float, coords.split())
 
-        # save into dictionary
-        coordinates[idx] = [lat, lon]
+def parse_chunk(df):
+    """
+    function prepares a chunk of the raw data.
+
+    - keep only the columns in COLUMNS
+    - filter the DataFrame so that only rows remain which have a location
+    - extract the coordinates into the columns lat and lon
+    - convert the columns into compact dtypes
+    - convert the date and add quarter and day of the week
+    """
+    # find rows without information concerning location and delete these rows
+    df = df[COLUMNS]
+    df = df[df.store_location.notnull()]
 
-    # replace values in column store_location
-    df.store_location = df.store_number.apply(lambda x: coordinates[x])
+    # extract the coordinate information, e.g. "POINT (-93.6 41.6)", and convert it into float.
+    # Only the distinct locations are parsed, the rows refer to them by the category codes.
+    # A chunk without any location is read as float column, its (empty) categories become strings
+    locations = df.store_location.astype('category')
+    categories = locations.cat.categories.astype(str)
+    coordinates = categories.str.extract(r'\((?P<lon>\S+)\s+(?P<lat>\S+)\)').astype('float64')
+    codes = locations.cat.codes.to_numpy()
+    df = df.drop(columns='store_location').assign(
+        lat=coordinates.lat.to_numpy()[codes],
+        lon=coordinates.lon.to_numpy()[codes],
+    )
 
-    # create a list of dictionaries for later use as markers in the map
-    markers = [{'id': str(ids), 'lat': coords[0], 'lon': coords[1]} for ids, coords in coordinates.items()]
+    # the measures become float32 or int32, the date a category (if it is not read by read_chunks)
+    df = df.astype(DTYPES)
 
-    # convert date column into date_time
-    df.date = pd.to_datetime(df.date)
+    # convert date column into date_time, again only the distinct dates are parsed
+    if isinstance(df.date.dtype, pd.CategoricalDtype):
+        df['date'] = pd.to_datetime(df.date.cat.categories).to_numpy()[df.date.cat.codes.to_numpy()]
+    else:
+        df['date'] = pd.to_datetime(df.date)
 
-    # add quarter of the year
-    df['quarter'] = df.date.dt.to_period('Q').astype(str)
+    # add quarter of the year, e.g. 2021Q1
+    key = df.date.dt.year * 10 + df.date.dt.quarter
+    df['quarter'] = key.astype('category').cat.rename_categories(lambda k: f'{k // 10}Q{k % 10}')
 
     # add day of the week
-    lookup = {
-        0: 'Monday',
-        1: 'Tuesday',
-        2: 'Wednesday',
-        3: 'Thursday',
-        4: 'Friday',
-        5: 'Saturday',
-        6: 'Sunday'
-    }
-    df['weekday'] = df.date.apply(lambda x: lookup[x.weekday()])
-
-    # group by store_number
-    gb = df.groupby('store_number')
-
-    # create a pandas.Series of json (for each group)
-    gb = gb.apply(lambda x: x.to_json())
-
-    # create a json from the pandas.Series
-    gb = gb.to_json()
-
-    # create a list of StoreLoc Objects (basically store number and location)
-    locations = [StoreLoc(k, *v) for k, v in coordinates.items()]
-
-    # create the tree with locations
-    kdt = KDTree(locations)
-
-    return gb, [kdt, locations, coordinates], markers
-
-
-# borrowed from dash_leaflet.express
-# I had problems importing dash_leaflet.express, so I just copied this code from github.
-# https://github.com/thedirtyfew/dash-leaflet/blob/master/dash_leaflet/express.py#L12-L20
-def dicts_to_geojson(dicts, lat="lat", lon="lon"):
-    geojson = {"type": "FeatureCollection", "features": []}
-    for d in dicts:
-        feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [d[lon], d[lat]]}}
-        props = [key for key in d.keys() if key not in [lat, lon]]
-        if props:
-            feature["properties"] = {prop: d[prop] for prop in props}
-        geojson["features"].append(feature)
-    return geojson
-
-
-# Class for the store location and number
-class StoreLoc:
-    def __init__(self, num, lat, lon):
-        self.num = num
-        self.lat = lat
-        self.lon = lon
-        self.location = [lat, lon]
-
-    def __getitem__(self, index):
-        return self.location[index]
+    df['weekday'] = pd.Categorical.from_codes(df.date.dt.dayofweek, categories=WEEKDAYS)
+    return df
+
+
+def concat_chunks(chunks):
+    """
+    function concatenates the chunks, the categories of the chunks are combined so that
+    the columns remain categorical. Empty chunks (e.g. without any location) are skipped.
+    """
+    chunks = [chunk for chunk in chunks if len(chunk)] or chunks[:1]
+    if len(chunks) == 1:
+        return chunks[0]
+
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks)
+
+
+def clean_data(df):
+    """
+    function cleans / enriches the raw data.
+
+    - prepare the raw data like a chunk, see parse_chunk
+    - use the same coordinates for all rows of a store
+    """
+    # DataFrame has not been read by read_data, e.g. in append_data
+    if 'store_location' in df.columns:
+        df = parse_chunk(df)
+
+    # location of each store (first location, if a store has more than one)
+    locations = df.groupby('store_number')[['lat', 'lon']].first()
+
+    # the coordinates of each store
+    df['lat'] = df.store_number.map(locations.lat)
+    df['lon'] = df.store_number.map(locations.lon)
+    return df
+
+
+def daily_totals(df, workers=None):
+    """
+    function returns the daily totals of the metrics, index is (store_number, quarter, date).
+
+    The stores are split into partitions of about the same number of rows, the totals of a
+    partition are summed by one thread of a pool of workers threads (default PREPARE_WORKERS).
+    A total is a bin of np.bincount, the bin of a row is its store and day. numpy releases the
+    GIL while it takes and counts the rows, so the partitions are summed in parallel. The rows
+    are summed in their order and a store is never split, so the totals do not depend on the
+    number of workers.
+
+    The measures are read as float32, the totals are summed as float64 and rounded to two
+    decimals like the raw data, integer measures keep their dtype.
+    """
+    workers = max(1, PREPARE_WORKERS if workers is None else int(workers))
+
+    # the bin of a row: the code of the store (in the order of the store numbers) and the day
+    codes, numbers = pd.factorize(df.store_number.to_numpy(), sort=True)
+    days = df.date.to_numpy().astype('datetime64[D]').view(np.int64)
+    first_day = int(days.min()) if len(days) else 0
+    n_days = int(days.max()) - first_day + 1 if len(days) else 1
+    bins = codes.astype(np.int64) * n_days + (days - first_day)
+    values = [df[metric].to_numpy() for metric in METRICS]
+
+    # the partition of every store: about the same number of rows per worker and at most
+    # MAX_BINS bins per partition, so that the memory of the sums of a partition is limited
+    counts = np.bincount(codes, minlength=len(numbers))
+    by_rows = np.minimum((np.cumsum(counts) - counts) * workers // max(len(bins), 1), workers - 1)
+    by_bins = np.arange(len(numbers)) // max(1, MAX_BINS // n_days)
+    _, partition = np.unique(by_rows * (len(numbers) + 1) + by_bins, return_inverse=True)
+    first_store = np.searchsorted(partition, np.arange(partition.max(initial=-1) + 2))
+
+    # the rows of the partitions, found with one stable (radix) sort. A single partition takes all rows
+    if len(first_store) > 2:
+        rows = np.argsort(partition.astype(np.uint16 if len(first_store) <= 1 << 16 else np.int64)[codes], kind='stable')
+        stops = np.cumsum(np.bincount(partition[codes], minlength=len(first_store) - 1))
+        parts = [(rows[start:stop], p) for p, (start, stop) in enumerate(zip(np.r_[0, stops[:-1]], stops))]
+    else:
+        parts = [(None, 0)] if len(bins) else []
+
+    def totals(part):
+        rows, p = part
+        offset = first_store[p] * n_days
+        size = first_store[p + 1] * n_days - offset
+        local = (bins if rows is None else bins[rows]) - offset
+        used = np.flatnonzero(np.bincount(local, minlength=size))
+        sums = [
+            np.bincount(local, weights=v if rows is None else v[rows], minlength=size)[used]
+            for v in values
+        ]
+        return used + offset, sums
+
+    if workers > 1 and len(parts) > 1:
+        with ThreadPoolExecutor(min(workers, len(parts))) as pool:
+            results = list(pool.map(totals, parts))
+    else:
+        results = [totals(part) for part in parts]
+
+    # the partitions are ranges of stores, so the bins of all partitions are sorted
+    used = np.concatenate([r[0] for r in results]) if results else np.empty(0, dtype=np.int64)
+    store_codes, day = np.divmod(used, n_days)
+    used_days, day_codes = np.unique(day, return_inverse=True)
+    dates = pd.DatetimeIndex((used_days + first_day).astype('datetime64[D]').astype('datetime64[ns]'))
+    quarters, quarter_codes = np.unique(dates.year * 10 + dates.quarter, return_inverse=True)
+
+    index = pd.MultiIndex(
+        levels=[numbers, [f'{k // 10}Q{k % 10}' for k in quarters], dates],
+        codes=[store_codes, quarter_codes[day_codes], day_codes],
+        names=['store_number', 'quarter', 'date']
+    )
+    cube = pd.DataFrame({
+        metric: np.concatenate([r[1][i] for r in results]) if results else np.empty(0)
+        for i, metric in enumerate(METRICS)
+    }, index=index)
+
+    # bincount sums float64, integer measures get their dtype again (the sums are exact)
+    integers = {metric: v.dtype for metric, v in zip(METRICS, values) if v.dtype.kind in 'iu'}
+    floats = [metric for metric in METRICS if metric not in integers]
+    cube = cube.astype(integers)
+    cube[floats] = cube[floats].round(2)
+    return cube
+
+
+def load_data(source=None, cache_dir=None):
+    """
+    function returns the cleaned and enriched DataFrame of the data source.
+
+    The DataFrame is cached as parquet file, the file name contains a hash of the
+    source. If the cache file exists, the raw data is neither downloaded nor parsed.
+    """
+    source = source or DATA_SOURCE
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+
+    if not cache_dir:
+        return read_data(source)
+
+    cache_file = os.path.join(cache_dir, f'liquor_{source_hash(source)}.parquet')
+    if os.path.isfile(cache_file):
+        return pd.read_parquet(cache_file)
+
+    df = read_data(source)
+
+    # write into a temporary file first, so that a concurrent reader never sees a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    df.to_parquet(tmp_file)
+    os.replace(tmp_file, cache_file)
+    return df
+
+
+def load_backend(source=None, cache_dir=None):
+    """
+    function returns the SqlStore of the data source. The SQLite file is created from the
+    chunks of the raw data, the file name contains a hash of the source.
+    """
+    if SQL_BACKEND != 'sqlite':
+        raise ValueError(f'unknown SQL backend {SQL_BACKEND!r}, only sqlite is supported')
+
+    source = source or DATA_SOURCE
+    cache_dir = (CACHE_DIR if cache_dir is None else cache_dir) or tempfile.mkdtemp()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    path = os.path.join(cache_dir, f'liquor_{source_hash(source)}.sqlite')
+    return SqlStore.build(path, read_chunks(source), METRICS)
+
+
+# progress of the data preparation of this process, e.g. for the readiness endpoint. It is changed
+# by the thread which prepares the data, other threads read it with progress_snapshot
+progress = {'stage': 'waiting', 'ready': False, 'error': None, 'seconds': {}}
+_progress_lock = threading.Lock()
+
+
+def update_progress(**values):
+    """function changes the values of progress"""
+    with _progress_lock:
+        progress.update(values)
+
+
+def progress_snapshot():
+    """function returns a copy of progress (including the durations of the stages)"""
+    with _progress_lock:
+        return dict(progress, seconds=dict(progress['seconds']))
+
+
+@contextmanager
+def stage(name):
+    """context manager which records the current stage of the data preparation and its duration"""
+    update_progress(stage=name)
+    start = time.perf_counter()
+    yield
+    seconds = round(time.perf_counter() - start, 3)
+    with _progress_lock:
+        progress['seconds'][name] = seconds
+
+
+def prepare_data(source=None, cache_dir=None):
+    """
+    function prepares the data for the app.
+
+    - read the cleaned data (from the cache, if possible)
+    - create an index of the store locations with the nearest neighbors of each store
+    - create the clusters of the store markers for the map
+    - create the daily totals of the metrics for each store and quarter
+
+    With the SQL backend the last step is replaced by the SQLite file of the transactions.
+    """
+    if SQL_BACKEND:
+        with stage('reading data'):
+            backend = load_backend(source, cache_dir)
+            locations = backend.locations()
+            cube = None
+    else:
+        backend = None
+        with stage('reading data'):
+            df = load_data(source, cache_dir)
+
+        with stage('aggregating data'):
+            # coordinates of each store
+            locations = df.groupby('store_number')[['lat', 'lon']].first()
+
+            # daily totals of the metrics, index is (store_number, quarter, date), summed by PREPARE_WORKERS threads
+            cube = daily_totals(df)
+
+    with stage('indexing stores'):
+        # create the index of the store locations (including the neighbors of each store)
+        stores = StoreIndex(locations.index, locations[['lat', 'lon']])
+
+    with stage('creating map layers'):
+        # create the clusters of the markers for every zoom level
+        clusters = ClusterIndex(stores.numbers, stores.coordinates)
+
+    return cube, stores, clusters, backend
+
+
+# Class for the prepared data, one instance is shared by all sessions of the process
+class Dataset:
+    # counter for the versions of the Dataset, used e.g. in the keys of the figure cache
+    _versions = itertools.count(1)
+
+    def __init__(self, cube, stores, clusters, backend=None):
+        self.version = next(Dataset._versions)
+        # daily totals of the metrics, index is (store_number, quarter, date)
+        self.cube = cube
+        # StoreIndex of the store locations
+        self.stores = stores
+        # ClusterIndex of the markers
+        self.clusters = clusters
+        # SqlStore of the transactions, replaces cube if it is used
+        self.backend = backend
+        # totals of the metrics per store and quarter, array of shape (stores, quarters, metrics),
+        # the stores are in the order of the StoreIndex
+        self.quarters, self.quarterly = self._quarterly_totals()
+
+    def _quarterly_totals(self):
+        if self.backend is not None:
+            df = self.backend.quarterly_totals()
+        else:
+            df = self.cube.groupby(level=['store_number', 'quarter'])[METRICS].sum()
+        quarters = sorted(df.index.unique('quarter'))
+        index = pd.MultiIndex.from_product([self.stores.numbers, quarters], names=['store_number', 'quarter'])
+        totals = df[METRICS].reindex(index, fill_value=0).to_numpy(dtype=np.float64)
+        return quarters, totals.reshape(len(self.stores), len(quarters), len(METRICS))
+
+    def totals(self, store_id, quarter=None, metrics=None):
+        """
+        function returns the daily totals of a single store (index is the date), optionally
+        only of a quarter and only of the given metrics. The lookup is a slice of the sorted
+        index, i.e. no filtering of the transactions is necessary.
+        """
+        if self.backend is not None:
+            return self.backend.totals(store_id, quarter, metrics)
+
+        key = (int(store_id),) if quarter is None else (int(store_id), quarter)
+        try:
+            df = self.cube.loc[key]
+        except KeyError:
+            # the store has no sales (in this quarter)
+            df = self.cube.iloc[:0].droplevel(['store_number', 'quarter'])
+        else:
+            if quarter is None:
+                df = df.droplevel('quarter')
+        if metrics is not None:
+            df = df[metrics]
+        return df
+
+    def selection_totals(self, store_numbers, metrics=None):
+        """
+        function returns the daily totals of several stores together (index is the date). The
+        rows of the stores are selected from the daily totals with one lookup of the store
+        level of the index, all stores are aggregated at once.
+        """
+        metrics = METRICS if metrics is None else list(metrics)
+        if self.backend is not None:
+            return self.backend.selection_totals(store_numbers, metrics)
+
+        index = self.cube.index
+        selected = np.isin(index.levels[0], np.asarray(store_numbers, dtype=np.int64))[index.codes[0]]
+        return self.cube.loc[selected, metrics].groupby(level='date').sum().round(2)
+
+    def quarterly_breakdown(self, store_numbers, metric='sale_dollars'):
+        """
+        function returns the totals of a metric of the stores per quarter (index is the store number, columns
+        are the quarters). The store numbers come from the browser, unknown stores are dropped.
+        """
+        store_numbers = np.unique(np.asarray(store_numbers, dtype=np.int64))
+        rows = np.minimum(np.searchsorted(self.stores.numbers, store_numbers), len(self.stores) - 1)
+        rows = rows[self.stores.numbers[rows] == store_numbers]
+        return pd.DataFrame(
+            self.quarterly[rows, :, METRICS.index(metric)], index=self.stores.numbers[rows], columns=self.quarters
+        )
+
+    def region(self, store_id, quarter=None, metric='sale_dollars', radius_km=None, k=None):
+        """
+        function compares the total of a metric of a store with the stores of its region, i.e.
+        all stores within radius_km or the k nearest stores (including the store itself). The
+        totals are of a quarter or, if quarter is None, of all quarters. Returns a dictionary
+        with the totals of the region, the percentile rank of the store, the median and the
+        quartiles of the region.
+        """
+        if radius_km is not None:
+            numbers, km = self.stores.within(store_id, radius_km)
+        else:
+            numbers, km = self.stores.nearest(store_id, min(int(k), len(self.stores)))
+
+        # one lookup of the totals of all stores of the region
+        column = METRICS.index(metric)
+        if quarter is None:
+            totals = self.quarterly[:, :, column].sum(axis=1)
+        elif quarter in self.quarters:
+            totals = self.quarterly[:, self.quarters.index(quarter), column]
+        else:
+            totals = np.zeros(len(self.stores))
+        values = totals[np.searchsorted(self.stores.numbers, numbers)]
+        value = totals[self.stores.row(store_id)]
+
+        # share of the stores with a lower total, equal totals count half
+        rank = 100 * ((values < value).sum() + 0.5 * (values == value).sum()) / len(values)
+        q1, median, q3 = np.percentile(values, [25, 50, 75])
+        return {
+            'numbers': numbers, 'km': km, 'values': values, 'value': value,
+            'rank': rank, 'median': median, 'q1': q1, 'q3': q3,
+        }
+
+    def append(self, df):
+        """
+        function returns a new Dataset with the cleaned and enriched rows of df added.
+
+        Only the daily totals of the stores in df are updated. The index of
+        the store locations and the clusters are only created again if df contains
+        new stores or stores with a new location. The Dataset itself is not changed, so
+        sessions which use it are not affected.
+        """
+        if df.empty:
+            return self
+
+        backend = self.backend
+        if backend is not None:
+            # the rows are inserted into the file of the appended rows, the old Dataset does not read them
+            backend = backend.append(df)
+            cube = None
+        else:
+            # add the daily totals of the new rows
+            cube = pd.concat([self.cube, daily_totals(df)]).groupby(level=['store_number', 'quarter', 'date']).sum()
+
+        # find new stores and stores which have been moved
+        locations = df.groupby('store_number')[['lat', 'lon']].first()
+        old_locations = pd.DataFrame(self.stores.coordinates, index=self.stores.numbers, columns=['lat', 'lon'])
+        known = locations.index.isin(old_locations.index)
+        moved = known.copy()
+        moved[known] = (locations[known] != old_locations.loc[locations.index[known]]).any(axis=1).to_numpy()
+
+        if known.all() and not moved.any():
+            return Dataset(cube, self.stores, self.clusters, backend)
+
+        locations = pd.concat([old_locations.drop(locations.index[moved]), locations[~known | moved]]).sort_index()
+        stores = StoreIndex(locations.index, locations[['lat', 'lon']])
+        clusters = ClusterIndex(stores.numbers, stores.coordinates)
+        return Dataset(cube, stores, clusters, backend)
+
+
+_dataset = None
+_dataset_lock = threading.Lock()
+
+# seconds until the data is prepared again by warm_up after the preparation failed
+RETRY_SECONDS = float(os.environ.get('LIQUOR_RETRY_SECONDS', 30))
+
+# the thread of warm_up and the time (time.monotonic) of the last failed preparation
+_warm_up_thread = None
+_warm_up_lock = threading.Lock()
+_failed_at = None
+
+# cache for the figures of the home page, shared by all sessions
+figure_cache = FigureCache()
+
+
+def get_dataset(refresh=False):
+    """
+    function returns the Dataset shared by all sessions of this process.
+
+    The data is prepared lazily on first use, the lock makes sure that concurrent
+    sessions do not prepare the data more than once. With refresh=True the data is
+    prepared again and replaces the current Dataset, sessions which still hold a
+    reference to the old Dataset are not affected. The cached figures of the old
+    Dataset are removed.
+    """
+    global _dataset, _failed_at
+    dataset = _dataset
+    if dataset is not None and not refresh:
+        return dataset
+
+    with _dataset_lock:
+        # another thread might have prepared the data while we were waiting for the lock
+        if _dataset is not None and (not refresh or _dataset is not dataset):
+            return _dataset
+
+        try:
+            _dataset = Dataset(*prepare_data())
+        except Exception as e:
+            _failed_at = time.monotonic()
+            update_progress(stage='failed', error=repr(e))
+            raise
+        update_progress(stage='ready', ready=True, error=None)
+        figure_cache.clear()
+        return _dataset
+
+
+def warm_up():
+    """
+    function prepares the shared Dataset in a background thread, so that the server can answer
+    requests (e.g. the readiness endpoint) in the meantime. Returns the thread.
+
+    Only one thread prepares the data, while it is running the same thread is returned. After a
+    failed preparation the data is prepared again at the earliest RETRY_SECONDS later, until
+    then the thread of the failed preparation is returned. So warm_up can be called on every
+    request, e.g. by the home page while it waits for the data.
+    """
+    global _warm_up_thread
+
+    def run():
+        try:
+            get_dataset()
+        except Exception:
+            # the error is recorded in progress, the next call of get_dataset tries again
+            pass
+
+    with _warm_up_lock:
+        thread = _warm_up_thread
+        if thread is not None and (
+                thread.is_alive() or _failed_at is not None and time.monotonic() - _failed_at < RETRY_SECONDS
+        ):
+            return thread
+
+        thread = _warm_up_thread = threading.Thread(target=run, name='warm_up', daemon=True)
+        thread.start()
+        return thread
+
+
+def append_data(rows):
+    """
+    function adds new transactions to the Dataset shared by all sessions without preparing
+    all data again, rows is a csv (path or URL) or a DataFrame with the columns of the raw data.
+
+    The new Dataset replaces the current one in a single step, sessions which still hold a
+    reference to the old Dataset are not affected. Note that the rows are not written into the
+    data source, they are lost when the data is prepared again.
+    """
+    global _dataset
+    if not isinstance(rows, pd.DataFrame):
+        rows = pd.read_csv(rows)
+    df = clean_data(rows)
+
+    # make sure that there is a Dataset, appends of concurrent threads are done one after another
+    get_dataset()
+    with _dataset_lock:
+        _dataset = _dataset.append(df)
+        figure_cache.clear()
+        return _dataset
+
+
+# Class for the store locations. The coordinates are kept in a contiguous array, row i
+# belongs to the store numbers[i]. The store numbers are sorted, a lookup of the row is a
+# binary search. The MAX_NEIGHBORS nearest stores of every store are computed in one
+# batched query of a BallTree with haversine (great circle) distances, so that a neighbor
+# lookup is just reading a row of the neighbor table.
+class StoreIndex:
+    def __init__(self, numbers, coordinates):
+        self.numbers = np.ascontiguousarray(numbers, dtype=np.int64)
+        # array of shape (number of stores, 2), columns are lat, lon
+        self.coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+        # hash of the stores and their locations, e.g. for the ETag of the map layers
+        self.etag = hashlib.sha1(self.numbers.tobytes() + self.coordinates.tobytes()).hexdigest()
+
+        # scikit-learn is imported here, its import takes longer than the start of the app
+        from sklearn.neighbors import BallTree
+        self.tree = BallTree(np.radians(self.coordinates), metric='haversine')
+
+        # neighbor table, row i contains the rows of the nearest stores of store i and the distances in km
+        dist, idx = self.tree.query(np.radians(self.coordinates), k=min(MAX_NEIGHBORS, len(self.numbers)))
+        self.neighbor_rows = idx.astype(np.int32)
+        self.neighbor_km = dist * EARTH_RADIUS_KM
 
     def __len__(self):
-        return 2
-
-
-# create a custom theme for the plotly figures
-# basically use the plotly_dark theme and change the first
-# color of the colorway to match with navbar color
-pio.templates["plotly_dark_custom"] = pio.templates["plotly_dark"]
-pio.templates["plotly_dark_custom"]['layout'].update(
-    {'colorway': (
-        '#375a7f',
-        '#EF553B',
-        '#00cc96',
-        '#ab63fa',
-        '#FFA15A',
-        '#19d3f3',
-        '#FF6692',
-        '#B6E880',
-        '#FF97FF',
-        '#FECB52'
+        return len(self.numbers)
+
+    def row(self, store_id):
+        """function returns the row of a store number, raises a KeyError for unknown stores"""
+        store_number = int(store_id)
+        row = int(np.searchsorted(self.numbers, store_number))
+        if row == len(self.numbers) or self.numbers[row] != store_number:
+            raise KeyError(store_number)
+        return row
+
+    def location(self, store_id):
+        """function returns [lat, lon] of a store"""
+        return self.coordinates[self.row(store_id)]
+
+    def nearest(self, store_id, k):
+        """
+        function returns the store numbers of the k nearest stores (including the store itself)
+        and their distances in km.
+        """
+        row = self.row(store_id)
+        if k <= self.neighbor_rows.shape[1]:
+            return self.numbers[self.neighbor_rows[row, :k]], self.neighbor_km[row, :k]
+
+        # more neighbors than precomputed, query the tree
+        dist, idx = self.tree.query(np.radians(self.coordinates[row]).reshape(1, -1), k)
+        return self.numbers[idx[0]], dist[0] * EARTH_RADIUS_KM
+
+    def in_polygon(self, ring):
+        """
+        function returns the store numbers of all stores within a polygon, ring is a list of
+        [lon, lat] like the coordinates of a GeoJSON polygon. The stores within the bounding box
+        of the polygon are tested by ray casting, one vectorized step per edge of the polygon.
+        """
+        ring = np.asarray(ring, dtype=np.float64)
+        (west, south), (east, north) = ring.min(axis=0), ring.max(axis=0)
+        lat, lon = self.coordinates[:, 0], self.coordinates[:, 1]
+        candidates = np.flatnonzero((lon >= west) & (lon <= east) & (lat >= south) & (lat <= north))
+        x, y = lon[candidates], lat[candidates]
+
+        # a point is inside if a ray to the west crosses the edges an odd number of times
+        inside = np.zeros(len(candidates), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y0 == y1:
+                continue
+            crosses = (y0 > y) != (y1 > y)
+            inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        return self.numbers[candidates[inside]]
+
+    def within(self, store_id, radius_km):
+        """
+        function returns the store numbers of all stores within radius_km of a store (including
+        the store itself) and their distances in km, sorted by distance.
+        """
+        point = np.radians(self.location(store_id)).reshape(1, -1)
+        idx, dist = self.tree.query_radius(
+            point, r=radius_km / EARTH_RADIUS_KM, return_distance=True, sort_results=True
+        )
+        return self.numbers[idx[0]], dist[0] * EARTH_RADIUS_KM
+
+
+def register_template():
+    """
+    function creates a custom theme for the plotly figures (once), it has to be called before
+    a figure uses figure_layout. Basically use the plotly_dark theme and change the first
+    color of the colorway to match with navbar color. plotly.io is not imported at start.
+    """
+    import plotly.io as pio
+    if 'plotly_dark_custom' in pio.templates:
+        return
+
+    pio.templates["plotly_dark_custom"] = pio.templates["plotly_dark"]
+    pio.templates["plotly_dark_custom"]['layout'].update(
+        {'colorway': (
+            '#375a7f',
+            '#EF553B',
+            '#00cc96',
+            '#ab63fa',
+            '#FFA15A',
+            '#19d3f3',
+            '#FF6692',
+            '#B6E880',
+            '#FF97FF',
+            '#FECB52'
+        )
+        }
     )
-    }
-)
 
 
-# layout for plotly figures
+def resample(df, rule):
+    """
+    function returns the sums of the daily totals df per period of the rule (see RESOLUTIONS),
+    a period is labeled with its first day. Daily totals are returned unchanged.
+    """
+    if rule == 'D':
+        return df
+    return df.resample(rule, label='left', closed='left').sum()
+
+
+def lttb(x, y, n_out):
+    """
+    function returns the indices of the n_out points of the series x, y which are kept by the
+    largest triangle three buckets algorithm. The shape of the line is preserved, i.e. peaks
+    are not averaged away. x may be datetimes.
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x)
+    x = (x.astype('datetime64[ns]').astype(np.int64) if np.issubdtype(x.dtype, np.datetime64) else x).astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # the first and the last point are always kept, the other points are split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # the third point of the triangle is the mean of the next bucket
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        mean_x, mean_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+
+        # keep the point of the bucket which forms the largest triangle with the previous point
+        area = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+# layout for plotly figures, see register_template
 figure_layout = {
     'margin': {'t': 10, 'b': 10, 'l': 0, 'r': 0},
     'template': 'plotly_dark_custom',